@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+import instrument
+from instrument import TRACER
+from download import DataDownloader, parse_partition_job
+
+
+class AsyncDataDownloader:
+    '''Asyncio front end of DataDownloader ingesting regions in the background.
+
+    Archives are downloaded by a thread pool and every region csv is parsed into its year partition of the npy
+    cache by an executor as soon as its archive arrives, so downloads overlap with parsing. Regions already
+    in the cache are ready at once without touching the network. Every region has a future resolved with its
+    columns (as get_list(output='columns') returns them), completed regions are also yielded by async iteration.'''
+
+    def __init__(self, downloader=None, regions=None, workers=None, executor=None, on_progress=None, **settings):
+        self.downloader = downloader or DataDownloader(**settings)
+        if self.downloader.cache_backend != 'npy':
+            raise ValueError("Background ingestion needs the npy cache backend")
+        self.regions = list(regions or self.downloader.regions.keys())
+        # parsing executor, a process pool of workers is created when none is given
+        self.workers = workers
+        self.executor = executor
+        # on_progress(progress) is called in the event loop after every change of the counters
+        self.on_progress = on_progress
+        self.stats = dict(archives=0, archives_done=0, bytes_downloaded=0, members=0, members_parsed=0,
+                          rows_parsed=0, regions=len(self.regions), regions_ready=0)
+        self.ready = {}
+        self.completed = None
+        self.task = None
+
+    def start(self):
+        '''Starts the ingestion in the running event loop, returns region -> future of its columns.'''
+        if self.task is None:
+            loop = asyncio.get_running_loop()
+            self.ready = {region: loop.create_future() for region in self.regions}
+            self.completed = asyncio.Queue()
+            self.task = loop.create_task(self.ingest())
+        return self.ready
+
+    def progress(self):
+        '''Snapshot of the counters: archives, bytes downloaded, csv members and rows parsed, regions ready.'''
+        return dict(self.stats)
+
+    def update(self, **increments):
+        for key, value in increments.items():
+            self.stats[key] += value
+        if self.on_progress is not None:
+            self.on_progress(self.progress())
+
+    async def wait(self):
+        '''Waits until every region is ingested, errors of the ingestion are raised.'''
+        self.start()
+        await asyncio.shield(self.task)
+
+    async def get_list(self, regions=None, output='list', years=None):
+        '''DataDownloader.get_list of the regions once all of them are ready.'''
+        self.start()
+        if regions is None:
+            regions = self.regions
+        if isinstance(regions, str):
+            regions = [regions]
+        await asyncio.gather(*(self.ready[region] for region in regions))
+        return self.downloader.get_list(regions, output, years=years)
+
+    def __aiter__(self):
+        return self.as_completed()
+
+    async def as_completed(self):
+        '''Yields (region, columns) in the order regions become ready.'''
+        self.start()
+        for _ in range(len(self.ready)):
+            region = await self.completed.get()
+            yield region, self.ready[region].result()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def close(self):
+        '''Cancels the ingestion if it is still running.'''
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        # errors of regions nobody waited for are dropped together with them
+        for future in [self.task] + list(self.ready.values()):
+            if future is not None and future.done() and not future.cancelled():
+                future.exception()
+
+    def resolve(self, region, error=None):
+        future = self.ready[region]
+        if future.done():
+            return
+        if error is None:
+            # region is in the cache of the downloader now, columns are only memory mapped
+            future.set_result(self.downloader.get_list([region], output='columns')[1])
+            self.update(regions_ready=1)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            future.cancel()
+        self.completed.put_nowait(region)
+
+    async def ingest(self):
+        downloader = self.downloader
+        missing = []
+        for region in self.regions:
+            if region in downloader.cache or downloader.search_cache_file(region):
+                self.resolve(region)
+            else:
+                missing.append(region)
+        if not missing:
+            return
+        try:
+            await self.fetch_and_parse(missing)
+        except BaseException as error:
+            for region in missing:
+                self.resolve(region, error)
+            raise
+
+    async def fetch_and_parse(self, regions):
+        '''Downloads all archives, members of the regions are parsed while other archives are still downloading.'''
+        loop = asyncio.get_running_loop()
+        downloader = self.downloader
+        io = ThreadPoolExecutor(max_workers=downloader.download_workers)
+        # workers are spawned, forking a process with running download threads is not safe
+        executor = self.executor or ProcessPoolExecutor(max_workers=self.workers,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+        jobs = {region: [] for region in regions}
+        members = {}
+        try:
+            files = await loop.run_in_executor(io, downloader.list_archives)
+            downloader.folder.mkdir(parents=True, exist_ok=True)
+            self.update(archives=len(files))
+
+            def received(size):
+                loop.call_soon_threadsafe(functools.partial(self.update, bytes_downloaded=size))
+
+            async def fetch(file):
+                status = await loop.run_in_executor(io, downloader.fetch_archive, file, received)
+                print("%s: %s" % (file, status))
+                members[file] = downloader.index_archive(downloader.folder / Path(file).name)
+                self.update(archives_done=1)
+                for region, member in members[file]:
+                    if region in jobs:
+                        jobs[region].append((member, loop.create_task(self.parse(executor, member, region))))
+                        self.update(members=1)
+
+            await asyncio.gather(*(fetch(file) for file in files))
+            # members indexed in the order of archives, the same as DataDownloader.download_data gives
+            downloader.index = {}
+            for file in files:
+                for region, member in members[file]:
+                    downloader.index.setdefault(region, []).append(member)
+            order = {member: i for i, member in enumerate(member for file in files for _, member in members[file])}
+            await asyncio.gather(*(self.finish_region(region, sorted(jobs[region], key=lambda job: order[job[0]]))
+                                   for region in regions))
+        finally:
+            for _, job in (job for region_jobs in jobs.values() for job in region_jobs):
+                job.cancel()
+            io.shutdown(wait=False, cancel_futures=True)
+            if self.executor is None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    async def parse(self, executor, member, region):
+        '''Parses one csv of the region into its year partition, returns the partition manifest entry.'''
+        loop = asyncio.get_running_loop()
+        entry, spans = await loop.run_in_executor(executor, parse_partition_job, self.downloader.settings(),
+                                                  member, region)
+        TRACER.merge(spans)
+        self.update(members_parsed=1, rows_parsed=entry['rows'])
+        return entry
+
+    async def finish_region(self, region, jobs):
+        '''Writes the partition manifest of the region once all its members are parsed and resolves it.'''
+        entries = await asyncio.gather(*(job for _, job in jobs))
+        self.downloader.write_partition_manifest(region, {str(member[2]): entry
+                                                          for (member, _), entry in zip(jobs, entries)})
+        self.downloader.cache[region] = self.downloader.load_cache(region)
+        self.resolve(region)
+
+
+async def main(regions=None):
+    start = time.perf_counter()
+    async with AsyncDataDownloader(regions=regions) as downloader:
+        async for region, columns in downloader:
+            progress = downloader.progress()
+            print("%6.2f s  %s: %d rows  (%d/%d regions, %.1f MB downloaded, %d rows parsed)" % (
+                time.perf_counter() - start, region, len(columns['f1']), progress['regions_ready'],
+                progress['regions'], progress['bytes_downloaded'] / 2 ** 20, progress['rows_parsed']))
+
+
+if __name__ == "__main__":
+    instrument.configure()
+    asyncio.run(main())
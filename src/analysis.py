@@ -5,46 +5,178 @@ from matplotlib import pyplot as plt
 import pandas as pd
 import seaborn as sns
 import numpy as np
-import gzip
-import pickle
+import time
 from pathlib import Path
-
-
-def get_dataframe(filename: str, verbose: bool = False) -> pd.DataFrame:
-    """Vyvorenie dataframu pre sledovane parametre zo subora s datami o nehodovosti v ČR"""
+from dataset import load_dataset
+from figcache import FIGURES
+import instrument
+from instrument import TRACER, input_rows, output_rows
+
+# stlpce potrebne pre grafy plot_conseq, plot_damage a plot_surface
+COLUMNS = ["p2a", "p12", "p13a", "p13b", "p13c", "p16", "p53", "region"]
+# explicitne typy stlpcov, ostatne stlpce dostanu najuzsi bezpecny typ
+SCHEMA = {"p12": "int32", "p13a": "int16", "p13b": "int16", "p13c": "int16", "p53": "int32", "region": "category"}
+# najvacsi pocet roznych hodnot celociselneho stlpca konvertovaneho na kategoriu
+CATEGORY_LIMIT = 256
+# rozpocet pamate konvertovaneho dataframu na workeroch so 4 GB
+MEMORY_BUDGET = 2 ** 30
+
+# intervaly priciny nehody (p12), skody (p53) a nazvy stavu vozovky (p16)
+P12_BINS = [0, 101, 210, 312, 415, 517, 616]
+P12_NAMES = ['nezaviněná řidičem', 'nepřiměřená rychlost jízdy', 'nesprávné předjíždění', 'nedání přednosti v jízdě',
+             'nesprávný způsob jízdy', 'technická závada vozidla']
+P53_BINS = [0, 50, 200, 500, 1000, np.inf]
+P53_NAMES = ['<50', '50-200', '200-500', '500-1000', '>1000']
+P16_NAMES = {0: "jiný stav", 1: "suchý neznečistený", 2: "suchý znečistený", 3: "mokrý", 4: "bláto",
+             5: "náledí(posypané)", 6: "náledí(neposypáno)", 7: "rozlitý olej, nafta apod.", 8: "souvislá sníh",
+             9: "náhlá změna stavu"}
+# stlpce agregacnej kocky, kluce a agregovane hodnoty
+CUBE_KEYS = ["region", "month", "p12", "p53", "p16"]
+CUBE_VALUES = ["p13a", "p13b", "p13c", "accidents"]
+
+
+def narrow_column(column: pd.Series, dtype: str = None) -> pd.Series:
+    """Konverzia stlpca na typ zo schemy, inak na najuzsi bezpecny typ: kategoria pre kody s malym poctom
+    hodnot, zmensene cele cisla a float32 ak sa hodnoty nezmenia"""
+    if dtype is not None:
+        return column.astype(dtype)
+    if column.dtype == object or pd.api.types.is_string_dtype(column.dtype):
+        if column.nunique(dropna=False) < len(column) / 2:
+            return column.astype("category")
+        return column
+    if pd.api.types.is_integer_dtype(column.dtype):
+        if column.nunique() <= CATEGORY_LIMIT:
+            return column.astype("category")
+        return pd.to_numeric(column, downcast="integer")
+    if pd.api.types.is_float_dtype(column.dtype):
+        narrow = column.astype("float32")
+        if np.array_equal(narrow.to_numpy(dtype="float64"), column.to_numpy(), equal_nan=True):
+            return narrow
+    return column
+
+
+@TRACER.instrument("get_dataframe", rows=output_rows)
+def get_dataframe(filename: str, verbose: bool = False, columns: list = None, regions: list = None,
+                  years: list = None, memory_budget: int = MEMORY_BUDGET) -> pd.DataFrame:
+    """Vyvorenie dataframu pre sledovane parametre zo subora s datami o nehodovosti v ČR,
+    nacitaju sa iba zvolene stlpce (predvolene vsetky) a particie zvolenych regionov a rokov;
+    dataframe nad rozpoctom pamate memory_budget (None bez kontroly) sa ohlasi"""
     print("Loading file data...")
-    with gzip.open(filename, 'rb') as f:
-        content = pickle.load(f)
+    start = time.perf_counter()
+    content = load_dataset(filename, columns, regions=regions, years=years)
+    loaded = time.perf_counter()
     if verbose:
-        print("orig_size={:.1f} MB".format(content.memory_usage(index=False, deep=True).sum() / 1048576))
+        # hlboke meranie prechadza vsetky retazce, robi sa iba pre vypis
+        before = content.memory_usage(index=False, deep=True)
+        print("orig_size={:.1f} MB".format(before.sum() / 1048576))
     print("Parsing data...")
-    regions = content["region"]
-    content = content.iloc[:, 0:-1].astype('category')
-    content["date"] = content["p2a"].astype("datetime64[ns]")
-    content["p13a"] = content["p13a"].astype("int16")
-    content["p13b"] = content["p13b"].astype("int16")
-    content["p13c"] = content["p13c"].astype("int16")
-    content["p12"] = content["p12"].astype("int32")
-    content["p53"] = content["p53"].astype("int32")
-    content["p53"] = content["p53"].div(10)
-
-    content["region"] = regions
+    content["date"] = pd.to_datetime(content["p2a"])
     content = content.drop(columns=["p2a"])
+    for name in content.columns:
+        if name != "date":
+            content[name] = narrow_column(content[name], SCHEMA.get(name))
+    if "p53" in content:
+        content["p53"] = content["p53"].div(10)
+    content = content[[name for name in content.columns if name not in ("date", "region")] + ["date", "region"]]
+    converted = time.perf_counter()
+
+    # odhad bez obsahu retazcov, po konverzii su takmer vsetky stlpce ciselne alebo kategorie
+    size = content.memory_usage(index=False).sum()
+    if memory_budget is not None and size > memory_budget:
+        print("Warning: dataframe takes {:.1f} MB over the budget of {:.1f} MB".format(size / 1048576,
+                                                                                     memory_budget / 1048576))
     if verbose:
-        print("new_size={:.1f} MB".format(content.memory_usage(index=False, deep=True).sum() / 1048576))
+        after = content.memory_usage(index=False, deep=True)
+        for name in content.columns:
+            source = "p2a" if name == "date" else name
+            print("{:<8} {:>9.2f} MB -> {:>7.2f} MB  {}".format(name, before[source] / 1048576, after[name] / 1048576,
+                                                          content[name].dtype))
+        print("new_size={:.1f} MB budget={}".format(after.sum() / 1048576, "none" if memory_budget is None else
+                                                    "{:.1f} MB".format(memory_budget / 1048576)))
+        print("load={:.2f} s convert={:.2f} s".format(loaded - start, converted - loaded))
     return content
 
 
+@TRACER.instrument("build_cube", rows=input_rows)
+def build_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """Agregacia dat v jednom priechode: pocet nehod a sucet nasledkov podla regionu, mesiaca, intervalu
+    priciny (p12), intervalu skody (p53) a stavu vozovky (p16), kody mimo intervalov su -1"""
+    print("Building aggregate cube...")
+    data = pd.DataFrame({
+        "region": df["region"],
+        "month": df["date"].to_numpy().astype("datetime64[M]"),
+        "p12": pd.cut(df["p12"], P12_BINS).cat.codes.astype("int8"),
+        "p53": pd.cut(df["p53"], P53_BINS).cat.codes.astype("int8"),
+        "p16": df["p16"].astype("float64").fillna(-1).astype("int16"),
+        "p13a": df["p13a"], "p13b": df["p13b"], "p13c": df["p13c"],
+        "accidents": np.ones(len(df), dtype="int64"),
+    })
+    cube = data.groupby(CUBE_KEYS, observed=True, dropna=False, sort=False).sum().reset_index()
+    cube.attrs["bins"] = [P12_BINS, P53_BINS]
+    return cube
+
+
+def is_cube(df: pd.DataFrame) -> bool:
+    """Test ci dataframe je agregacna kocka"""
+    return set(CUBE_KEYS + CUBE_VALUES) <= set(df.columns)
+
+
+def get_cube(filename: str, cube_filename: str = None) -> pd.DataFrame:
+    """Nacitanie agregacnej kocky ulozenej vedla datasetu, kocka sa prepocita ak je dataset novsi
+    alebo sa zmenili intervaly"""
+    filename = Path(filename)
+    cube_filename = Path(cube_filename or filename.with_name(filename.name.split(".")[0] + ".cube.pkl"))
+    if cube_filename.is_file() and cube_filename.stat().st_mtime >= filename.stat().st_mtime:
+        cube = pd.read_pickle(cube_filename)
+        if cube.attrs.get("bins") == [P12_BINS, P53_BINS]:
+            return cube
+    cube = build_cube(get_dataframe(filename, columns=COLUMNS))
+    cube.to_pickle(cube_filename)
+    return cube
+
+
+def conseq_data(cube: pd.DataFrame) -> pd.DataFrame:
+    """Nasledky nehod a pocet nehod v regionoch zoradene podla poctu nehod"""
+    data = cube.groupby("region")[CUBE_VALUES].sum().reset_index()
+    return data.sort_values(by=["accidents"], ascending=False)
+
+
+def damage_data(cube: pd.DataFrame) -> pd.DataFrame:
+    """Pocet nehod podla regionu, priciny a skody"""
+    data = pd.DataFrame({
+        "region": cube["region"],
+        "p12": pd.Categorical.from_codes(cube["p12"], P12_NAMES, ordered=True),
+        "Škoda [tisíc Kč]": pd.Categorical.from_codes(cube["p53"], P53_NAMES, ordered=True),
+        "accidents": cube["accidents"],
+    })
+    return data.groupby(['region', 'p12', 'Škoda [tisíc Kč]'])['accidents'].sum().reset_index(name='Počet nehôd')
+
+
+def surface_data(cube: pd.DataFrame, region: str) -> pd.DataFrame:
+    """Mesacny pocet nehod regionu podla stavu vozovky"""
+    data = cube[cube["month"].notna()]
+    states = sorted(data["p16"].unique())
+    data = data[data["region"] == region]
+    table = data.pivot_table(index="month", columns="p16", values="accidents", aggfunc="sum", fill_value=0)
+    months = pd.date_range(table.index.min(), table.index.max(), freq="MS") if len(table) else table.index
+    table = table.reindex(index=months, columns=states, fill_value=0).rename(columns=P16_NAMES)
+    table.index = (table.index + pd.offsets.MonthEnd(0)).rename("Datum vzniku nehody")
+    table.columns.name = "p16"
+    return table.stack().reset_index(name="Počet nehôd")
+
+
 # Ukol 2: následky nehod v jednotlivých regionech
+@TRACER.instrument("plot_conseq", rows=input_rows)
 def plot_conseq(df: pd.DataFrame, fig_location: str = None,
                 show_figure: bool = False):
-    """Vykreslenie grafu analyzujúceho následky nehôd v jednotlivých regiónoch"""
+    """Vykreslenie grafu analyzujúceho následky nehôd v jednotlivých regiónoch,
+    df su data nehod alebo ich agregacna kocka"""
     # data processing
     print("Processing data...")
-    data = df[['p13a', 'p13b', 'p13c', 'region']].copy().groupby(["region"]).sum().reset_index()
-    test = df[['p13a', 'region']].copy().groupby(["region"]).count().reset_index()
-    data['accidents'] = test['p13a']
-    sorted = data.sort_values(by=["accidents"], ascending=False)
+    sorted = conseq_data(df if is_cube(df) else build_cube(df))
+    key = FIGURES.key(plot_conseq, sorted)
+    if FIGURES.fetch(key, fig_location, show_figure):
+        return
 
     # data visualization
     if fig_location or show_figure:
@@ -81,28 +213,27 @@ def plot_conseq(df: pd.DataFrame, fig_location: str = None,
         start, end = axes[3].get_ylim()
         axes[3].yaxis.set_ticks(np.arange(start, end, 30000))
 
-        plt.tight_layout()
+        fig.tight_layout()
         if show_figure:
             plt.show()
         if fig_location:
             print(f"Storing the file... {fig_location}")
-            plt.savefig(fig_location)
+            fig.savefig(fig_location)
+            FIGURES.store(key, fig_location)
 
 
 # Ukol3: příčina nehody a škoda
+@TRACER.instrument("plot_damage", rows=input_rows)
 def plot_damage(df: pd.DataFrame, fig_location: str = None,
                 show_figure: bool = False):
-    """Vykreslenie grafu analyzujúceho príčiny nehôd a ich dopad na škody"""
+    """Vykreslenie grafu analyzujúceho príčiny nehôd a ich dopad na škody,
+    df su data nehod alebo ich agregacna kocka"""
     print("Processing data...")
-    bins = [0, 101, 210, 312, 415, 517, 616]
-    names = ['nezaviněná řidičem', 'nepřiměřená rychlost jízdy', 'nesprávné předjíždění', 'nedání přednosti v jízdě',
-             'nesprávný způsob jízdy', 'technická závada vozidla']
-    data = df[['p53', 'p12', 'region']].copy()
-    data['p12'] = pd.cut(data['p12'], bins, labels=names)
-    ranges = [0, 50, 200, 500, 1000, np.inf]
-    ranges_strings = ['<50', '50-200', '200-500', '500-1000', '>1000']
-    data['Škoda [tisíc Kč]'] = pd.cut(data['p53'], ranges, labels=ranges_strings)
-    result = data.groupby(['region', 'p12', 'Škoda [tisíc Kč]'])['p53'].count().reset_index(name='Počet nehôd')
+    result = damage_data(df if is_cube(df) else build_cube(df))
+    # graf zobrazuje iba styri regiony, zmena dat ostatnych ho neinvaliduje
+    key = FIGURES.key(plot_damage, result[result["region"].isin(["PHA", "PLK", "JHC", "OLK"])])
+    if FIGURES.fetch(key, fig_location, show_figure):
+        return
 
     # data visualization
     if fig_location or show_figure:
@@ -135,42 +266,32 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None,
         axes[1][1].set_title("PLK")
 
         handles, labels = axes[1][1].get_legend_handles_labels()
-        plt.legend(handles, labels, title="Příčina nehody", loc='center left', bbox_to_anchor=(1, 0.88), shadow=False, ncol=1)
+        axes[1][1].legend(handles, labels, title="Příčina nehody", loc='center left', bbox_to_anchor=(1, 0.88), shadow=False, ncol=1)
 
-        plt.tight_layout()
+        fig.tight_layout()
         if show_figure:
             plt.show()
         if fig_location:
             print(f"Storing the file... {fig_location}")
-            plt.savefig(fig_location)
+            fig.savefig(fig_location)
+            FIGURES.store(key, fig_location)
 
 
 # Ukol 4: povrch vozovky
+@TRACER.instrument("plot_surface", rows=input_rows)
 def plot_surface(df: pd.DataFrame, fig_location: str = None,
                  show_figure: bool = False):
-    """Vykreslenie grafu analyzujúceho stavu vozovky a ich vplyvu na nehodovost"""
+    """Vykreslenie grafu analyzujúceho stavu vozovky a ich vplyvu na nehodovost,
+    df su data nehod alebo ich agregacna kocka"""
     print("Processing data...")
-    data = df[['region', 'date', 'p16']].copy()
-    crosstable = pd.crosstab(index=[data['region'], data['date']], columns=data['p16'])
-    crosstable = crosstable.rename(columns={0: "jiný stav",
-                                            1: "suchý neznečistený", 2: "suchý znečistený", 3: "mokrý",
-                                            4: "bláto", 5: "náledí(posypané)",
-                                            6: "náledí(neposypáno)", 7: "rozlitý olej, nafta apod.",
-                                            8: "souvislá sníh",
-                                            9: "náhlá změna stavu"})
-    grouped = crosstable.groupby(['region', 'date']).sum()
-    olk = grouped.query('region == "ZLK"')
-    jhc = grouped.query('region == "JHC"')
-    jhm = grouped.query('region == "LBK"')
-    plk = grouped.query('region == "PLK"')
-    olk_result = olk.resample("M", level=1).sum().stack().reset_index().rename(
-        columns={0: "Počet nehôd", "date": "Datum vzniku nehody"})
-    jhc_result = jhc.resample("M", level=1).sum().stack().reset_index().rename(
-        columns={0: "Počet nehôd", "date": "Datum vzniku nehody"})
-    jhm_result = jhm.resample("M", level=1).sum().stack().reset_index().rename(
-        columns={0: "Počet nehôd", "date": "Datum vzniku nehody"})
-    plk_result = plk.resample("M", level=1).sum().stack().reset_index().rename(
-        columns={0: "Počet nehôd", "date": "Datum vzniku nehody"})
+    cube = df if is_cube(df) else build_cube(df)
+    olk_result = surface_data(cube, "ZLK")
+    jhc_result = surface_data(cube, "JHC")
+    jhm_result = surface_data(cube, "LBK")
+    plk_result = surface_data(cube, "PLK")
+    key = FIGURES.key(plot_surface, olk_result, jhc_result, jhm_result, plk_result)
+    if FIGURES.fetch(key, fig_location, show_figure):
+        return
 
     # data visualization
     if fig_location or show_figure:
@@ -200,22 +321,24 @@ def plot_surface(df: pd.DataFrame, fig_location: str = None,
         axes[1][1].set_title("PLK")
 
         handles, labels = axes[1][1].get_legend_handles_labels()
-        plt.legend(handles, labels,
+        axes[1][1].legend(handles, labels,
                    loc='center left',
                    bbox_to_anchor=(1, 0.78), shadow=False, ncol=1)
 
-        plt.tight_layout()
+        fig.tight_layout()
         if show_figure:
             plt.show()
         if fig_location:
             print(f"Storing the file... {fig_location}")
-            plt.savefig(fig_location)
+            fig.savefig(fig_location)
+            FIGURES.store(key, fig_location)
 
 
 if __name__ == "__main__":
     # defaultly the output is stored in a file 01_nasledky.png/02_priciny.png/03_stav.png
+    instrument.configure()
     main_folder = Path(__file__).parent.parent.resolve()
-    df = get_dataframe(main_folder / "accidents.pkl.gz")
-    plot_conseq(df, fig_location=main_folder / "graphs/01_nasledky.png")
-    plot_damage(df, fig_location=main_folder / "graphs/02_priciny.png")
-    plot_surface(df, fig_location=main_folder / "graphs/03_stav.png")
\ No newline at end of file
+    cube = get_cube(main_folder / "accidents.pkl.gz")
+    plot_conseq(cube, fig_location=main_folder / "graphs/01_nasledky.png")
+    plot_damage(cube, fig_location=main_folder / "graphs/02_priciny.png")
+    plot_surface(cube, fig_location=main_folder / "graphs/03_stav.png")
\ No newline at end of file
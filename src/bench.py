@@ -0,0 +1,367 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import matplotlib
+matplotlib.use("Agg")
+
+import argparse as ap
+import csv
+import datetime
+import gc
+import inspect
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import time
+import traceback
+import zipfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+import analysis
+import doc
+import geo
+import get_stat
+from coords import REGION_BOUNDS
+from dataset import load_dataset, read_manifest
+from download import DataDownloader
+from figcache import FIGURES
+from instrument import peak_rss, reset_peak_rss, rss
+
+MAIN_FOLDER = Path(__file__).parent.parent.resolve()
+WORKDIR = MAIN_FOLDER / ".bench"
+HISTORY = MAIN_FOLDER / "bench_history.json"
+SCALES = [10000]
+# to_csv renamed line_terminator to lineterminator in pandas 1.5, requirements.txt pins an older pandas
+LINE_TERMINATOR = "lineterminator" if "lineterminator" in inspect.signature(pd.DataFrame.to_csv).parameters \
+    else "line_terminator"
+SEED = 0
+# archives of the datagis layout, the last year is a partial year archive
+ARCHIVES = {2016: "datagis2016.zip", 2017: "datagis-rok-2017.zip", 2018: "datagis-rok-2018.zip",
+            2019: "datagis-rok-2019.zip", 2020: "datagis-09-2020.zip"}
+# csv rows generated and written at once, bounds the memory of the generator
+CHUNK_ROWS = 100000
+# share of numeric values replaced by XX/empty sentinels and of coordinates replaced by A:
+SENTINELS = 0.01
+WORDS = ["GN_V0.1UIRS", "GN_V0.1UIR-ADR_", "Plzeň", "České Budějovice", "Ústí nad Labem", "Jihlava", "Zlín",
+         "ulice, č. p.", "silnice I/26", "dálnice D1", "Brno-střed", "Olomouc", "A:", ""]
+# string forms of small integers and of two decimal digits, looked up instead of formatting every value
+NUMBERS = np.arange(1000).astype(str).astype(object)
+DECIMALS = np.char.zfill(np.arange(100).astype(str), 2).astype(object)
+REGIONS = ["PHA", "STC", "JHC", "PLK", "ULK", "HKK", "JHM", "MSK", "OLK", "ZLK", "VYS", "PAK", "LBK", "KVK"]
+
+
+def csv_chunk(rng, d_type, names, rows: int, first_id: int, year: int, region: str) -> bytes:
+    """Rows of one region csv in the datagis format: windows-1250, ';' delimited, every value quoted,
+    decimal comma and XX/A:/empty sentinels of missing data"""
+    columns = {}
+    xmin, ymin, xmax, ymax = REGION_BOUNDS[region]
+    for name in names:
+        kind = d_type[name].kind
+        if name == "f1":
+            values = (np.arange(rows, dtype=np.int64) + first_id).astype(str)
+        elif kind == "M":
+            days = np.datetime64("%d-01-01" % year) + rng.integers(0, 365, rows).astype("timedelta64[D]")
+            values = days.astype(str)
+        elif kind in "iu":
+            values = NUMBERS[rng.integers(0, len(NUMBERS), rows)]
+            values[rng.random(rows) < SENTINELS] = "XX"
+            values[rng.random(rows) < SENTINELS] = ""
+        elif kind == "f":
+            low, high = (xmin, xmax) if name == "f47" else (ymin, ymax) if name == "f48" else (0, 1000)
+            cents = rng.integers(int(low * 100), int(high * 100), rows)
+            # decimal comma, the sign is kept on the integer part of negative coordinates
+            whole, fraction = np.divmod(np.abs(cents), 100)
+            values = np.where(cents < 0, "-", "").astype(object) + whole.astype(str).astype(object) + "," + \
+                DECIMALS[fraction]
+            values[rng.random(rows) < SENTINELS] = "A:"
+        else:
+            values = np.asarray(WORDS, dtype=object)[rng.integers(0, len(WORDS), rows)]
+        columns[name] = values
+    text = pd.DataFrame(columns, columns=names).to_csv(sep=";", header=False, index=False, quoting=csv.QUOTE_ALL,
+                                                         **{LINE_TERMINATOR: "\r\n"})
+    return text.encode("windows-1250")
+
+
+def generate_archives(folder, rows: int, seed: int = SEED, downloader: DataDownloader = None) -> list:
+    """Zip archives of region csv files mimicking the datagis layout with about `rows` rows in total,
+    rows are split evenly among years and regions and written in chunks"""
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    downloader = downloader or DataDownloader(folder=folder)
+    rng = np.random.default_rng(seed)
+    names = downloader.col_list[:-1]
+    member_rows = max(1, rows // (len(ARCHIVES) * len(downloader.regions)))
+    files = []
+    for year, archive in ARCHIVES.items():
+        filename = folder / archive
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as z:
+            for region, code in downloader.regions.items():
+                first_id = (int(code) * 10000 + year) * 10 ** 8
+                with z.open(code + ".csv", "w", force_zip64=True) as member:
+                    for start in range(0, member_rows, CHUNK_ROWS):
+                        member.write(csv_chunk(rng, downloader.csv_dtype, names, min(CHUNK_ROWS, member_rows - start),
+                                               first_id + start, year, region))
+        files.append(filename)
+    return files
+
+
+def generate_dataset(filename, rows: int, seed: int = SEED) -> pd.DataFrame:
+    """Pickled dataset with the columns of accidents.pkl.gz, coordinates lie in the region of the accident"""
+    rng = np.random.default_rng(seed)
+    region = np.asarray(REGIONS)[rng.integers(0, len(REGIONS), rows)]
+    bounds = np.array([REGION_BOUNDS[name] for name in REGIONS])[pd.Categorical(region, REGIONS).codes]
+    dates = np.datetime64("2016-01-01") + rng.integers(0, 5 * 365, rows).astype("timedelta64[D]")
+    df = pd.DataFrame({
+        "p1": np.arange(rows, dtype=np.int64) + 10 ** 9,
+        "p36": rng.integers(0, 9, rows),
+        "p37": np.where(rng.random(rows) < 0.05, "", rng.integers(1, 3000, rows).astype(str)).astype(object),
+        "p2a": dates.astype(str).astype(object),
+        "p2b": rng.integers(0, 2400, rows),
+        "p5a": rng.integers(1, 3, rows),
+        "p11": rng.integers(-1, 10, rows),
+        "p12": rng.choice([100, 201, 205, 301, 401, 501, 503, 601, 615], rows),
+        "p13a": rng.poisson(0.02, rows),
+        "p13b": rng.poisson(0.1, rows),
+        "p13c": rng.poisson(0.3, rows),
+        "p16": rng.integers(0, 10, rows),
+        "p18": np.where(rng.random(rows) < 0.05, "", rng.integers(1, 8, rows).astype(str)).astype(object),
+        "p19": rng.integers(1, 8, rows),
+        "p53": rng.integers(0, 20000, rows),
+        "d": np.where(rng.random(rows) < SENTINELS, np.nan, rng.uniform(bounds[:, 0], bounds[:, 2])),
+        "e": np.where(rng.random(rows) < SENTINELS, np.nan, rng.uniform(bounds[:, 1], bounds[:, 3])),
+        "h": rng.choice(WORDS[:2] + [""], rows),
+        "region": region,
+    })
+    df.to_pickle(filename)
+    return df
+
+
+def prepare(rows: int, workdir=WORKDIR, seed: int = SEED, regenerate: bool = False) -> dict:
+    """Synthetic archives and dataset of the scale, generated once and reused by later runs"""
+    directory = Path(workdir) / str(rows)
+    context = {"rows": rows, "directory": directory, "data": directory / "data",
+               "dataset": directory / "accidents.pkl.gz", "figures": directory / "graphs"}
+    done = directory / "done"
+    if regenerate or not done.is_file() or done.read_text() != str(seed):
+        shutil.rmtree(directory, ignore_errors=True)
+        print("Generating {} rows...".format(rows))
+        generate_archives(context["data"], rows, seed)
+        generate_dataset(context["dataset"], rows, seed)
+        done.write_text(str(seed))
+    context["figures"].mkdir(exist_ok=True)
+    return context
+
+
+def open_downloader(context: dict, clear: bool = False) -> DataDownloader:
+    """Downloader reading the synthetic archives, nothing is downloaded"""
+    downloader = DataDownloader(folder=context["data"])
+    if clear:
+        for region in downloader.regions:
+            shutil.rmtree(context["data"] / downloader.cache_dirname.format(region), ignore_errors=True)
+    downloader.open_archives(sorted(context["data"].glob("*.zip")))
+    return downloader
+
+
+# benchmarks get the context of the scale, do their untimed setup and return the timed function
+
+def bench_parse_region_data(context):
+    downloader = open_downloader(context)
+    return lambda: downloader.parse_region_data("PHA")
+
+
+def bench_get_list(context):
+    downloader = open_downloader(context, clear=True)
+    return lambda: downloader.get_list(output="columns")
+
+
+def bench_save_cache(context):
+    downloader = open_downloader(context)
+    downloader.cache["PHA"] = downloader.parse_region_data("PHA")[1]
+    return lambda: downloader.save_cache("PHA")
+
+
+def bench_load_cache(context):
+    downloader = open_downloader(context)
+    if not downloader.search_cache_file("PHA"):
+        downloader.cache["PHA"] = downloader.parse_region_data("PHA")[1]
+        downloader.save_cache("PHA")
+    return lambda: downloader.load_cache("PHA")
+
+
+def bench_get_accident_stats(context):
+    data_source = open_downloader(context).get_list(output="columns")
+    return lambda: get_stat.get_accident_stats(data_source)
+
+
+def bench_get_dataframe(context):
+    read_manifest(context["dataset"])
+    return lambda: analysis.get_dataframe(context["dataset"], columns=analysis.COLUMNS)
+
+
+def bench_make_geo(context):
+    df = load_dataset(context["dataset"], geo.COLUMNS)
+    return lambda: geo.make_geo(df)
+
+
+def bench_plot(function, load):
+    """Benchmark of a plot function, load prepares its input from the context"""
+    def setup(context):
+        data = load(context)
+        return lambda: function(data, context["figures"] / (function.__name__ + ".png"))
+    return setup
+
+
+def load_cube(context):
+    return analysis.get_cube(context["dataset"])
+
+
+def load_geo(context):
+    return geo.make_geo(load_dataset(context["dataset"], geo.COLUMNS))
+
+
+def load_doc(context):
+    return doc.stream_data(context["dataset"])
+
+
+def plot_data(data, fig_location):
+    doc.plot_data(*data, fig_location=fig_location)
+
+
+BENCHMARKS = {
+    "parse_region_data": bench_parse_region_data,
+    "get_list": bench_get_list,
+    "save_cache": bench_save_cache,
+    "load_cache": bench_load_cache,
+    "get_accident_stats": bench_get_accident_stats,
+    "get_dataframe": bench_get_dataframe,
+    "make_geo": bench_make_geo,
+    "plot_conseq": bench_plot(analysis.plot_conseq, load_cube),
+    "plot_damage": bench_plot(analysis.plot_damage, load_cube),
+    "plot_surface": bench_plot(analysis.plot_surface, load_cube),
+    "plot_data": bench_plot(plot_data, load_doc),
+    "plot_stat": bench_plot(get_stat.plot_stat, lambda context: open_downloader(context).get_list(output="columns")),
+    "plot_geo": bench_plot(geo.plot_geo, load_geo),
+    "plot_cluster": bench_plot(geo.plot_cluster, load_geo),
+}
+
+
+def run_benchmark(name: str, context: dict, connection):
+    """Forked worker, runs the setup and the timed function of one benchmark and sends its measurements"""
+    try:
+        FIGURES.enabled = False
+        function = BENCHMARKS[name](context)
+        gc.collect()
+        reset_peak_rss()
+        baseline = rss()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        peak = peak_rss()
+        plt.close("all")
+        connection.send({"seconds": seconds, "peak_rss_mb": peak / 2 ** 20,
+                         "delta_rss_mb": max(0, peak - baseline) / 2 ** 20})
+    except Exception:
+        connection.send({"error": traceback.format_exc()})
+    finally:
+        connection.close()
+
+
+def measure(name: str, context: dict) -> dict:
+    """Measurements of one benchmark in a fresh forked process, so peak memory of earlier runs does not count"""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(target=run_benchmark, args=(name, context, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    return result or {"error": "worker exited with code {}".format(process.exitcode)}
+
+
+def git_commit():
+    """Current commit and whether the tree has uncommitted changes, None outside of a git repository"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=MAIN_FOLDER, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=MAIN_FOLDER,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def load_history(filename=HISTORY) -> list:
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def save_history(history: list, filename=HISTORY):
+    tmp = Path(filename).with_name(".tmp-%d-" % os.getpid() + Path(filename).name)
+    with open(tmp, "w") as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def compare(previous: dict, run: dict):
+    """Prints ratios of time and peak memory against the previous run of the same benchmarks and scales"""
+    before = {(result["name"], result["rows"]): result for result in previous["results"] if "error" not in result}
+    print("Compared with {} ({}):".format(previous.get("commit"), previous.get("date")))
+    for result in run["results"]:
+        old = before.get((result["name"], result["rows"]))
+        if old is None or "error" in result:
+            continue
+        print("{:<20} {:>9} rows  time x{:.2f}  peak rss x{:.2f}".format(
+            result["name"], result["rows"], result["seconds"] / max(old["seconds"], 1e-9),
+            result["peak_rss_mb"] / max(old["peak_rss_mb"], 1e-9)))
+
+
+if __name__ == "__main__":
+    parser = ap.ArgumentParser(description="bench.py")
+    parser.add_argument("--rows", type=int, nargs="+", default=SCALES, help="scales from 10000 to 10000000 rows")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS.keys()), default=list(BENCHMARKS.keys()))
+    parser.add_argument("--repeat", type=int, default=1, help="best time and largest peak of repeated runs")
+    parser.add_argument("--workdir", default=WORKDIR)
+    parser.add_argument("--history", default=HISTORY)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--regenerate", action="store_true")
+    parser.add_argument("--no-history", action="store_true")
+    arguments = parser.parse_args()
+
+    commit, dirty = git_commit()
+    run = {"commit": commit, "dirty": dirty, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+           "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+           "seed": arguments.seed, "results": []}
+    for rows in arguments.rows:
+        context = prepare(rows, arguments.workdir, arguments.seed, arguments.regenerate)
+        for name in arguments.only:
+            measurements = [measure(name, context) for _ in range(arguments.repeat)]
+            errors = [measurement["error"] for measurement in measurements if "error" in measurement]
+            if errors:
+                result = {"name": name, "rows": rows, "error": errors[0]}
+                print("{:<20} {:>9} rows  FAILED\n{}".format(name, rows, errors[0]))
+            else:
+                result = {"name": name, "rows": rows,
+                          "seconds": min(measurement["seconds"] for measurement in measurements),
+                          "peak_rss_mb": max(measurement["peak_rss_mb"] for measurement in measurements),
+                          "delta_rss_mb": max(measurement["delta_rss_mb"] for measurement in measurements)}
+                print("{:<20} {:>9} rows  {:>8.3f} s  peak rss {:>8.1f} MB (+{:.1f} MB)".format(
+                    name, rows, result["seconds"], result["peak_rss_mb"], result["delta_rss_mb"]))
+            run["results"].append(result)
+
+    if not arguments.no_history:
+        history = load_history(arguments.history)
+        if history:
+            compare(history[-1], run)
+        history.append(run)
+        save_history(history, arguments.history)
+        print("History saved to {}".format(arguments.history))
+    exit(1 if any("error" in result for result in run["results"]) else 0)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import argparse as ap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import sklearn.cluster
+from dataset import REGION, read_manifest, select_groups
+from coords import group_coordinates
+
+N_CLUSTERS = 17
+SEED = 0
+CHUNK_ROWS = 262144
+BATCH_SIZE = 1024
+
+
+def cluster_path(filename) -> Path:
+    """Directory with fitted clusters belonging to the pickled dataset file"""
+    filename = Path(filename)
+    return filename.with_name(filename.name.split(".")[0] + ".clusters")
+
+
+def coordinate_parts(filename, region: str = None, year: int = None) -> list:
+    """Cleaned (x, y) column pairs of the region (all regions if None) and year read memory mapped from the
+    coordinate store, rejected coordinates are NaN, partitions of other regions and years are not opened"""
+    groups = select_groups(read_manifest(filename), None if region is None else [region],
+                           None if year is None else [year])
+    return [(coordinates["x"], coordinates["y"]) for coordinates in
+            (group_coordinates(filename, group) for group in groups)]
+
+
+def chunk_points(parts: list, chunk_rows: int):
+    """Splits the column pairs to (part, start, stop) chunks of at most chunk_rows rows"""
+    return [(index, start, min(start + chunk_rows, len(x)))
+            for index, (x, _) in enumerate(parts) for start in range(0, len(x), chunk_rows)]
+
+
+def read_chunk(parts: list, chunk) -> np.ndarray:
+    """Finite points of the chunk as (n, 2) float64 array"""
+    index, start, stop = chunk
+    x, y = parts[index]
+    points = np.column_stack((np.asarray(x[start:stop], dtype=np.float64), np.asarray(y[start:stop], dtype=np.float64)))
+    return points[np.isfinite(points).all(axis=1)]
+
+
+def fit_clusters(parts: list, n_clusters: int = N_CLUSTERS, seed: int = SEED, chunk_rows: int = CHUNK_ROWS):
+    """Clusters points of the (x, y) column pairs, returns cluster centers and number of points in every cluster.
+
+    Points that fit into one chunk are clustered at once, larger inputs are streamed chunk by chunk in a seeded
+    random order, so only one chunk of points is held in memory at a time. Every chunk is shuffled and fed
+    to partial_fit in minibatches of BATCH_SIZE points, one call per chunk would make only a few center updates."""
+    chunks = chunk_points(parts, chunk_rows)
+    rows = sum(stop - start for _, start, stop in chunks)
+    n_clusters = max(1, min(n_clusters, rows))
+    model = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, batch_size=BATCH_SIZE, n_init=3)
+    if len(chunks) <= 1:
+        points = read_chunk(parts, chunks[0]) if chunks else np.empty((0, 2))
+        if len(points) < n_clusters:
+            return points, np.ones(len(points), dtype=np.int64)
+        labels = model.fit(points).labels_
+        return model.cluster_centers_, np.bincount(labels, minlength=n_clusters)
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(chunks))
+    # first partial_fit needs at least n_clusters points, short chunks are moved to the end
+    order = sorted(order, key=lambda i: chunks[i][2] - chunks[i][1] < n_clusters)
+    fitted = False
+    for i in order:
+        points = read_chunk(parts, chunks[i])
+        points = points[rng.permutation(len(points))]
+        start = 0
+        while start < len(points):
+            # the first batch initializes the centers, it is as large as init_size of MiniBatchKMeans.fit
+            batch = points[start:start + (BATCH_SIZE if fitted else 3 * BATCH_SIZE)]
+            if fitted or len(batch) >= n_clusters:
+                model.partial_fit(batch)
+                fitted = True
+            start += len(batch)
+    counts = np.zeros(n_clusters, dtype=np.int64)
+    if not fitted:
+        return np.empty((0, 2)), counts[:0]
+    for chunk in chunks:
+        points = read_chunk(parts, chunk)
+        if len(points):
+            counts += np.bincount(model.predict(points), minlength=n_clusters)
+    return model.cluster_centers_, counts
+
+
+def fit_weighted(points: np.ndarray, weights: np.ndarray, n_clusters: int = N_CLUSTERS, seed: int = SEED):
+    """Clusters weighted points (e.g. cells of the spatial index weighted by their accident counts),
+    returns cluster centers and sums of weights in every cluster"""
+    n_clusters = max(1, min(n_clusters, len(points)))
+    model = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, batch_size=BATCH_SIZE, n_init=3)
+    labels = model.fit(points, sample_weight=weights).labels_
+    return model.cluster_centers_, np.bincount(labels, weights=weights, minlength=n_clusters).astype(np.int64)
+
+
+def cluster_region(filename, region: str = None, year: int = None, n_clusters: int = N_CLUSTERS,
+                   seed: int = SEED, chunk_rows: int = CHUNK_ROWS, cache: bool = True):
+    """Cluster centers and counts of accidents in the region and year (None means all), fitted clusters
+    are cached next to the dataset until it changes"""
+    path = cluster_path(filename) / "{}_{}_{}_{}_{}.npz".format(region or "all", year or "all", n_clusters,
+                                                              seed, chunk_rows)
+    if cache and os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(filename):
+        with np.load(path) as stored:
+            return stored["centers"], stored["counts"]
+    centers, counts = fit_clusters(coordinate_parts(filename, region, year), n_clusters, seed, chunk_rows)
+    if cache:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(".tmp-%d-" % os.getpid() + path.name)
+        np.savez(tmp, centers=centers, counts=counts)
+        os.replace(tmp, path)
+    return centers, counts
+
+
+def cluster_regions(filename, regions: list = None, year: int = None, workers: int = None, **options) -> dict:
+    """Clusters every region (all regions of the dataset if None) in a process pool, workers read
+    their region from the column store themselves"""
+    if regions is None:
+        regions = sorted({group[REGION] for group in read_manifest(filename)["groups"]})
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {region: pool.submit(cluster_region, filename, region, year, **options) for region in regions}
+        return {region: jobs[region].result() for region in regions}
+
+
+if __name__ == "__main__":
+    main_folder = Path(__file__).parent.parent.resolve()
+    parser = ap.ArgumentParser(description="cluster.py")
+    parser.add_argument("--dataset", default=main_folder / "accidents.pkl.gz")
+    parser.add_argument("--regions", nargs="+", default=None)
+    parser.add_argument("--year", type=int, default=None)
+    parser.add_argument("--clusters", type=int, default=N_CLUSTERS)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-cache", action="store_true")
+    arguments = parser.parse_args()
+    start = time.perf_counter()
+    result = cluster_regions(arguments.dataset, arguments.regions, arguments.year, arguments.workers,
+                             n_clusters=arguments.clusters, chunk_rows=arguments.chunk_rows,
+                             cache=not arguments.no_cache)
+    for region, (centers, counts) in result.items():
+        print("{}: {} clusters, largest {} accidents".format(region, len(centers), counts.max() if len(counts) else 0))
+    print("Clustered in {:.2f} s".format(time.perf_counter() - start))
@@ -0,0 +1,137 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def write_columns(directory, columns, **meta):
+    '''Stores every column as uncompressed .npy file next to a small json manifest.
+
+    Columns are written to a temporary directory which replaces the target at once,
+    concurrent writers and readers never see a partially written store.'''
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=directory.name + ".tmp-", dir=directory.parent))
+    names = list(columns.keys())
+    for name in names:
+        np.save(tmp / (name + ".npy"), np.ascontiguousarray(columns[name]), allow_pickle=False)
+    manifest = dict(meta, columns=names, rows=len(columns[names[0]]) if names else 0,
+                    dtype=[[name, np.asarray(columns[name]).dtype.str] for name in names])
+    with open(tmp / MANIFEST, 'w') as f:
+        json.dump(manifest, f)
+    replace_directory(tmp, directory)
+    return manifest
+
+
+def replace_directory(src, dst):
+    '''Moves src directory to dst, an existing dst is moved aside first and removed.'''
+    old = None
+    if os.path.isdir(dst):
+        old = tempfile.mkdtemp(prefix=Path(dst).name + ".old-", dir=Path(dst).parent)
+        os.replace(dst, Path(old) / "store")
+    os.replace(src, dst)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def read_manifest(directory):
+    '''Loads manifest of the column directory.'''
+    with open(Path(directory) / MANIFEST, 'r') as f:
+        return json.load(f)
+
+
+def read_columns(directory, names=None, mmap_mode='r'):
+    '''Opens columns of the directory memory mapped, only touched pages get read from disk.
+    Columns are cut to the row count of the manifest, rows of an unfinished append are not seen.'''
+    directory = Path(directory)
+    manifest = read_manifest(directory)
+    if names is None:
+        names = manifest['columns']
+    return {name: np.load(directory / (name + ".npy"), mmap_mode=mmap_mode, allow_pickle=False)[:manifest.get('rows')]
+            for name in names}
+
+
+def has_columns(directory):
+    '''Checks whether the directory holds a complete column store.'''
+    return os.path.isfile(Path(directory) / MANIFEST)
+
+
+def write_manifest(directory, manifest):
+    '''Replaces the manifest of the column directory at once.'''
+    fd, tmp = tempfile.mkstemp(prefix=MANIFEST + ".tmp-", dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, Path(directory) / MANIFEST)
+
+
+def npy_header(f):
+    '''Reads header of the open .npy file, returns its version, shape, dtype and the offset of the data.'''
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if fortran_order or len(shape) != 1:
+        raise ValueError("%s is not a one dimensional column" % f.name)
+    return version, shape[0], dtype, f.tell()
+
+
+def append_columns(directory, columns):
+    '''Appends rows to every column of the directory in place, only the new rows are written.
+
+    Rows are written behind the data of each .npy file before its header gets the new length (the header
+    of numpy keeps room for a longer shape) and the manifest is replaced last, its row count commits the append.
+    Rows of an interrupted append behind the row count of the manifest are overwritten, so a retry never stores
+    them twice. Columns are checked before anything is written, ValueError is raised when they do not match
+    the stored ones.'''
+    directory = Path(directory)
+    manifest = read_manifest(directory)
+    names = manifest['columns']
+    if set(names) != set(columns):
+        raise ValueError("Appended columns differ from the stored ones")
+    rows = len(columns[names[0]]) if names else 0
+    stored = manifest['rows']
+    headers = {}
+    for name in names:
+        with open(directory / (name + ".npy"), 'rb') as f:
+            version, length, dtype, offset = npy_header(f)
+        values = np.asarray(columns[name])
+        if values.dtype != dtype or len(values) != rows:
+            raise ValueError("Column %s does not match the stored %s" % (name, dtype))
+        if length < stored:
+            raise ValueError("Column %s is shorter than its manifest" % name)
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else \
+            np.lib.format.write_array_header_2_0
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (stored + rows,)})
+        if header.tell() != offset:
+            raise ValueError("Header of column %s has no room for %d rows" % (name, stored + rows))
+        headers[name] = (header.getvalue(), offset + stored * dtype.itemsize)
+    for name in names:
+        header, end = headers[name]
+        with open(directory / (name + ".npy"), 'r+b') as f:
+            # rows left behind by an interrupted append are overwritten
+            f.seek(end)
+            f.write(np.ascontiguousarray(columns[name]).tobytes())
+            f.truncate()
+            f.flush()
+            f.seek(0)
+            f.write(header)
+    manifest['rows'] = stored + rows
+    write_manifest(directory, manifest)
+    return manifest
+
+
+def update_columns(directory, positions, columns):
+    '''Overwrites rows at the positions in the given columns of the directory in place.'''
+    for name, values in columns.items():
+        column = np.load(Path(directory) / (name + ".npy"), mmap_mode='r+', allow_pickle=False)
+        column[positions] = values
+        column.flush()
+        del column
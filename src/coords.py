@@ -0,0 +1,185 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import argparse as ap
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+from colstore import write_columns, read_columns, read_manifest as read_columns_manifest, has_columns
+from dataset import MANIFEST, REGION, read_manifest, select_groups, store_path
+
+SJTSK = "EPSG:5514"
+CHUNK_ROWS = 1048576
+MARGIN = 10000
+RULES = ["missing", "zero", "outside_country", "outside_region"]
+FIXES = ["negated", "swapped"]
+
+# priblizny rozsah krajov v WGS84 (lon min, lat min, lon max, lat max)
+REGION_LONLAT = {
+    "PHA": (14.22, 49.94, 14.71, 50.18),
+    "STC": (13.40, 49.53, 15.55, 50.71),
+    "JHC": (13.53, 48.55, 15.60, 49.61),
+    "PLK": (12.65, 49.05, 13.95, 50.10),
+    "KVK": (12.09, 49.92, 13.30, 50.46),
+    "ULK": (12.98, 50.15, 14.70, 51.06),
+    "LBK": (14.40, 50.45, 15.45, 51.06),
+    "HKK": (15.20, 50.00, 16.60, 50.79),
+    "PAK": (15.35, 49.60, 16.88, 50.20),
+    "VYS": (14.87, 49.00, 16.40, 49.87),
+    "JHM": (15.53, 48.55, 17.65, 49.64),
+    "OLK": (16.65, 49.25, 17.85, 50.45),
+    "ZLK": (17.15, 48.85, 18.40, 49.50),
+    "MSK": (17.15, 49.40, 18.86, 50.33),
+}
+COUNTRY_LONLAT = (12.09, 48.55, 18.86, 51.06)
+
+
+def sjtsk_bounds(lonlat, margin: float = MARGIN):
+    """Rozsah v S-JTSK (xmin, ymin, xmax, ymax) zvacseny o margin metrov"""
+    xmin, ymin, xmax, ymax = Transformer.from_crs("EPSG:4326", SJTSK, always_xy=True).transform_bounds(*lonlat)
+    return xmin - margin, ymin - margin, xmax + margin, ymax + margin
+
+
+REGION_BOUNDS = {region: sjtsk_bounds(lonlat) for region, lonlat in REGION_LONLAT.items()}
+COUNTRY_BOUNDS = sjtsk_bounds(COUNTRY_LONLAT)
+
+
+def inside(x: np.ndarray, y: np.ndarray, bounds) -> np.ndarray:
+    """Test bodov na obdlznik, bounds su skalary alebo polia po riadkoch"""
+    xmin, ymin, xmax, ymax = bounds
+    return (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+
+def empty_report() -> dict:
+    return {name: 0 for name in ["rows"] + RULES + FIXES}
+
+
+def clean_chunk(x, y, region=None):
+    """Vycistenie suradnic S-JTSK jedneho bloku, vracia x, y (NaN pre zamietnute riadky) a pocty pravidiel
+
+    Kladne suradnice (bez znamienka) sa neguju, prehodene osi sa vymenia, ak opravene suradnice lezia
+    v kraji. Zamietaju sa chybajuce a nulove suradnice a body mimo CR alebo mimo vlastneho kraja."""
+    x = np.array(x, dtype=np.float64)
+    y = np.array(y, dtype=np.float64)
+    report = empty_report()
+    report["rows"] = len(x)
+    if region is None or isinstance(region, str):
+        bounds = REGION_BOUNDS.get(region, COUNTRY_BOUNDS)
+    else:
+        # hranice kraja po riadkoch, nezname kraje dostanu hranice CR
+        codes = pd.Categorical(np.asarray(region).astype(str), categories=list(REGION_BOUNDS.keys())).codes
+        table = np.array(list(REGION_BOUNDS.values()) + [COUNTRY_BOUNDS]).T
+        bounds = tuple(table[i][codes] for i in range(4))
+
+    missing = ~(np.isfinite(x) & np.isfinite(y))
+    zero = ~missing & ((x == 0) | (y == 0))
+    report["missing"] = int(missing.sum())
+    report["zero"] = int(zero.sum())
+    # opravy sa pouziju iba ak opraveny bod lezi v kraji
+    candidate = ~missing & ~zero & ~inside(x, y, bounds)
+    negated = candidate & inside(-x, -y, bounds)
+    swapped = candidate & ~negated & inside(y, x, bounds)
+    both = candidate & ~negated & ~swapped & inside(-y, -x, bounds)
+    x[negated], y[negated] = -x[negated], -y[negated]
+    x[swapped], y[swapped] = y[swapped], x[swapped]
+    x[both], y[both] = -y[both], -x[both]
+    report["negated"] = int((negated | both).sum())
+    report["swapped"] = int((swapped | both).sum())
+
+    rejected = missing | zero
+    outside_country = ~rejected & ~inside(x, y, COUNTRY_BOUNDS)
+    outside_region = ~rejected & ~outside_country & ~inside(x, y, bounds)
+    report["outside_country"] = int(outside_country.sum())
+    report["outside_region"] = int(outside_region.sum())
+    rejected |= outside_country | outside_region
+    x[rejected] = np.nan
+    y[rejected] = np.nan
+    return x, y, report
+
+
+def clean_coordinates(x, y, region=None, chunk_rows: int = CHUNK_ROWS):
+    """Vycistenie suradnic po blokoch chunk_rows riadkov (vstup moze byt aj memmap), region je kod kraja
+    pre vsetky riadky alebo pole kodov po riadkoch, pocty pravidiel sa scitaju"""
+    out_x = np.empty(len(x), dtype=np.float64)
+    out_y = np.empty(len(y), dtype=np.float64)
+    report = empty_report()
+    for start in range(0, len(x), chunk_rows):
+        stop = min(start + chunk_rows, len(x))
+        chunk_region = region if region is None or isinstance(region, str) else np.asarray(region[start:stop])
+        out_x[start:stop], out_y[start:stop], chunk_report = clean_chunk(x[start:stop], y[start:stop], chunk_region)
+        for name, count in chunk_report.items():
+            report[name] += count
+    return out_x, out_y, report
+
+
+def reproject(x, y, crs: str, chunk_rows: int = CHUNK_ROWS):
+    """Prevod suradnic S-JTSK do crs po blokoch, NaN zostavaju NaN"""
+    transformer = Transformer.from_crs(SJTSK, crs, always_xy=True)
+    out_x = np.empty(len(x), dtype=np.float64)
+    out_y = np.empty(len(y), dtype=np.float64)
+    for start in range(0, len(x), chunk_rows):
+        stop = min(start + chunk_rows, len(x))
+        out_x[start:stop], out_y[start:stop] = transformer.transform(np.asarray(x[start:stop], dtype=np.float64),
+                                                                     np.asarray(y[start:stop], dtype=np.float64))
+    # pyproj meni NaN na inf, zamietnute riadky musia zostat NaN
+    rejected = np.isnan(np.asarray(x, dtype=np.float64)) | np.isnan(np.asarray(y, dtype=np.float64))
+    out_x[rejected] = np.nan
+    out_y[rejected] = np.nan
+    return out_x, out_y
+
+
+def coordinates_path(filename, crs: str = SJTSK) -> Path:
+    """Adresar vycistenych suradnic v crs patriaci k suboru s datami"""
+    filename = Path(filename)
+    return filename.with_name(filename.name.split(".")[0] + ".coords") / crs.replace(":", "-").lower()
+
+
+def group_coordinates(filename, group: dict, crs: str = SJTSK) -> dict:
+    """Vycistene (a prevedene) suradnice riadkovej skupiny datasetu, vysledok sa uklada do stlpcoveho
+    uloziska a pocita sa znova iba ked je dataset novsi"""
+    directory = coordinates_path(filename, crs) / group["path"]
+    if has_columns(directory) and os.path.getmtime(directory) >= os.path.getmtime(store_path(filename) / MANIFEST):
+        return dict(read_columns(directory), report=read_columns_manifest(directory)["report"])
+    if crs == SJTSK:
+        columns = read_columns(store_path(filename) / group["path"], ["d", "e"])
+        x, y, report = clean_coordinates(columns["d"], columns["e"], group[REGION])
+    else:
+        base = group_coordinates(filename, group, SJTSK)
+        x, y = reproject(base["x"], base["y"], crs)
+        report = base["report"]
+    write_columns(directory, {"x": x, "y": y}, crs=crs, report=report)
+    return {"x": x, "y": y, "report": report}
+
+
+def load_coordinates(filename, crs: str = SJTSK, regions: list = None, years: list = None):
+    """Vycistene suradnice v poradi riadkov load_dataset(filename, regions=regions, years=years)
+    a sucet poctov pravidiel"""
+    parts, report = [], empty_report()
+    for group in select_groups(read_manifest(filename), regions, years):
+        columns = group_coordinates(filename, group, crs)
+        parts.append((columns["x"], columns["y"]))
+        for name, count in columns["report"].items():
+            report[name] += count
+    x = np.concatenate([part[0] for part in parts]) if parts else np.empty(0)
+    y = np.concatenate([part[1] for part in parts]) if parts else np.empty(0)
+    return x, y, report
+
+
+def print_report(report: dict):
+    rejected = sum(report[name] for name in RULES)
+    print("Coordinates: {} rows, {} rejected ({}), {} fixed ({})".format(
+        report["rows"], rejected, ", ".join("{} {}".format(name, report[name]) for name in RULES),
+        sum(report[name] for name in FIXES), ", ".join("{} {}".format(name, report[name]) for name in FIXES)))
+
+
+if __name__ == "__main__":
+    main_folder = Path(__file__).parent.parent.resolve()
+    parser = ap.ArgumentParser(description="coords.py")
+    parser.add_argument("--dataset", default=main_folder / "accidents.pkl.gz")
+    parser.add_argument("--crs", default=SJTSK, help="EPSG:5514, EPSG:4326 or EPSG:3857")
+    parser.add_argument("--regions", nargs="+", default=None)
+    parser.add_argument("--years", nargs="+", type=int, default=None)
+    arguments = parser.parse_args()
+    print_report(load_coordinates(arguments.dataset, arguments.crs, arguments.regions, arguments.years)[2])
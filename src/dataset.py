@@ -0,0 +1,192 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import json
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from colstore import write_columns, read_columns, replace_directory
+
+REGION = "region"
+YEAR = "year"
+DATE = "p2a"
+MANIFEST = "dataset.json"
+# row groups are partitioned by region and year of the accident, stores of other layouts are rebuilt
+PARTITIONING = [REGION, YEAR]
+CHUNK_ROWS = 65536
+
+
+def store_path(filename) -> Path:
+    """Directory of the column store belonging to the pickled dataset file"""
+    filename = Path(filename)
+    return filename.with_name(filename.name.split(".")[0] + ".cols")
+
+
+def encode_column(column: pd.Series):
+    """Splits column to array stored as .npy and json description needed to decode it"""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), {"kind": "category", "values": column.cat.categories.tolist()}
+    if column.dtype == object or pd.api.types.is_string_dtype(column.dtype):
+        # strings and mixed values are dictionary encoded, missing values get code -1
+        codes, values = pd.factorize(column)
+        return codes.astype(np.int32), {"kind": "object", "values": values.tolist()}
+    return column.to_numpy(), {"kind": "plain"}
+
+
+def column_decoder(encoding: dict):
+    """Function decoding stored values of a column, the vocabulary is built only once"""
+    if encoding["kind"] == "category":
+        categories = pd.Index(encoding["values"])
+        return lambda values: pd.Categorical.from_codes(values, categories)
+    if encoding["kind"] == "object":
+        vocab = np.empty(len(encoding["values"]) + 1, dtype=object)
+        vocab[:-1] = encoding["values"]
+        vocab[-1] = np.nan
+        return lambda values: vocab[values]
+    return lambda values: values
+
+
+def decode_column(values: np.ndarray, encoding: dict):
+    """Inverse of encode_column"""
+    return column_decoder(encoding)(values)
+
+
+def column_dates(values: np.ndarray, encoding: dict) -> np.ndarray:
+    """Date column as datetime64, dictionary encoded strings are parsed only once per distinct value"""
+    if encoding["kind"] == "plain":
+        return pd.to_datetime(values).to_numpy()
+    vocab = pd.to_datetime(pd.Series(encoding["values"] + [None]), errors="coerce").to_numpy()
+    return vocab[np.asarray(values)]
+
+
+def group_path(region: str, year) -> str:
+    """Partition directory of the row group, rows without a date go to year=none"""
+    return "%s=%s/%s=%s" % (REGION, region, YEAR, "none" if year is None else year)
+
+
+def convert_dataset(filename, directory=None) -> dict:
+    """Converts pickled dataset to column store with one row group per region and year,
+    the manifest keeps row counts and min/max dates of every group"""
+    directory = Path(directory or store_path(filename))
+    df = pd.read_pickle(filename)
+    df = df.reset_index(drop=True)
+    arrays, encodings = {}, {}
+    for name in df.columns:
+        arrays[name], encodings[name] = encode_column(df[name])
+    dates = column_dates(arrays[DATE], encodings[DATE]) if DATE in arrays else np.full(len(df), "NaT", "M8[D]")
+    regions, region_codes = np.unique(df[REGION].astype(str).to_numpy(), return_inverse=True)
+    years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+    # rows without a date sort after all years of their region
+    years = np.where(np.isnat(dates), np.iinfo(np.int64).max, years)
+    order = np.lexsort((years, region_codes))
+    keys = np.stack((region_codes[order], years[order]))
+    starts = np.flatnonzero(np.concatenate(([True], (keys[:, 1:] != keys[:, :-1]).any(axis=0))))
+
+    tmp = Path(tempfile.mkdtemp(prefix=directory.name + ".tmp-", dir=directory.parent))
+    groups = []
+    for start, stop in zip(starts, np.append(starts[1:], len(order))):
+        rows = order[start:stop]
+        region = str(regions[keys[0, start]])
+        year = None if keys[1, start] == np.iinfo(np.int64).max else int(keys[1, start])
+        path = group_path(region, year)
+        write_columns(tmp / path, {name: arrays[name][rows] for name in df.columns})
+        valid = dates[rows][~np.isnat(dates[rows])]
+        groups.append({"path": path, REGION: region, YEAR: year, "rows": len(rows),
+                       "date_min": str(valid.min().astype("datetime64[D]")) if len(valid) else None,
+                       "date_max": str(valid.max().astype("datetime64[D]")) if len(valid) else None})
+    manifest = {"columns": df.columns.tolist(), "dtypes": {name: arrays[name].dtype.str for name in df.columns},
+                "encodings": encodings, "partitioning": PARTITIONING, "groups": groups}
+    with open(tmp / MANIFEST, "w") as f:
+        json.dump(manifest, f)
+    replace_directory(tmp, directory)
+    return manifest
+
+
+def read_manifest(filename) -> dict:
+    """Manifest of the dataset column store, the store is (re)built when missing or older than the dataset"""
+    directory = store_path(filename)
+    manifest = directory / MANIFEST
+    if not os.path.isfile(manifest) or (os.path.isfile(filename)
+                                        and os.path.getmtime(filename) > os.path.getmtime(manifest)):
+        print("Converting dataset to column store...")
+        return convert_dataset(filename, directory)
+    with open(manifest, "r") as f:
+        content = json.load(f)
+    if content.get("partitioning") != PARTITIONING:
+        print("Converting dataset to partitioned column store...")
+        return convert_dataset(filename, directory)
+    return content
+
+
+def select_groups(manifest: dict, regions: list = None, years: list = None, date_from=None, date_to=None) -> list:
+    """Row groups that can hold rows of the regions, years and date range (None means any),
+    other partitions are pruned without being opened, a single region may be given as a string"""
+    if isinstance(regions, str):
+        regions = [regions]
+    date_from = pd.Timestamp(date_from) if date_from is not None else None
+    date_to = pd.Timestamp(date_to) if date_to is not None else None
+    years = None if years is None else {int(year) for year in np.atleast_1d(years)}
+    groups = []
+    for group in manifest["groups"]:
+        if regions is not None and group[REGION] not in regions:
+            continue
+        if years is not None and group[YEAR] not in years:
+            continue
+        if date_from is not None and group.get("date_max") and pd.Timestamp(group["date_max"]) < date_from:
+            continue
+        if date_to is not None and group.get("date_min") and pd.Timestamp(group["date_min"]) > date_to:
+            continue
+        groups.append(group)
+    return groups
+
+
+def load_dataset(filename, columns: list = None, regions: list = None,
+                 date_from=None, date_to=None, years: list = None) -> pd.DataFrame:
+    """Loads the dataset, only requested columns and row groups of matching regions, years and dates are read.
+
+    Rows come grouped by region and year in the order of the row groups of the store (regions sorted by name,
+    years ascending), not in the order of the pickled dataset; within a group they keep their original order.
+    Callers pairing rows of several loads by position must load them with the same regions and years."""
+    manifest = read_manifest(filename)
+    directory = store_path(filename)
+    names = manifest["columns"] if columns is None else list(columns)
+    date_from = pd.Timestamp(date_from) if date_from is not None else None
+    date_to = pd.Timestamp(date_to) if date_to is not None else None
+    filter_dates = date_from is not None or date_to is not None
+    read = names + [DATE] if filter_dates and DATE not in names else names
+
+    parts = {name: [] for name in names}
+    for group in select_groups(manifest, regions, years, date_from, date_to):
+        data = read_columns(directory / group["path"], read)
+        rows = slice(None)
+        if filter_dates:
+            dates = column_dates(data[DATE], manifest["encodings"][DATE])
+            mask = ~np.isnat(dates)
+            if date_from is not None:
+                mask &= dates >= date_from.to_datetime64()
+            if date_to is not None:
+                mask &= dates <= date_to.to_datetime64()
+            rows = np.flatnonzero(mask)
+        for name in names:
+            parts[name].append(data[name][rows])
+
+    return pd.DataFrame({name: decode_column(np.concatenate(parts[name]) if parts[name]
+                                             else np.empty(0, dtype=manifest["dtypes"][name]),
+                                             manifest["encodings"][name]) for name in names}, columns=names)
+
+
+def iter_dataset(filename, columns: list = None, regions: list = None, chunk_rows: int = CHUNK_ROWS,
+                 years: list = None):
+    """Yields the dataset as frames of at most chunk_rows rows, row groups are read memory mapped
+    and only the rows of the current chunk are decoded"""
+    manifest = read_manifest(filename)
+    directory = store_path(filename)
+    names = manifest["columns"] if columns is None else list(columns)
+    decoders = {name: column_decoder(manifest["encodings"][name]) for name in names}
+    for group in select_groups(manifest, regions, years):
+        data = read_columns(directory / group["path"], names)
+        for start in range(0, group["rows"], chunk_rows):
+            yield pd.DataFrame({name: decoders[name](np.asarray(data[name][start:start + chunk_rows]))
+                                for name in names}, columns=names)
@@ -7,13 +7,44 @@ import pandas as pd
 import seaborn as sns
 import scipy.stats
 import matplotlib.pyplot as plt
-
-
-def load_data(filename: str):
+from dataset import load_dataset, iter_dataset
+import instrument
+from instrument import TRACER, input_rows
+
+CHUNK_ROWS = 65536
+
+# intervals of road types (p37) and labels of studied conditions
+TYP_SILNICE = [0, 100, 1000, np.inf]
+SILNICE = [
+    "dálnice alebo cesta 1. triedy", 
+    "cesta 2. triedy", 
+    "cesta 3. triedy"
+]
+POCASIE_ENUM = [0, 2, 3, 4, 5, 6, 7]
+POCASIE = [
+    "jiné stížené",
+    "mlha",
+    "mrholení",
+    "déšť",
+    "sněžení",
+    "námraza",
+    "nárazový vítr",
+]
+VIDITELNOST_ENUM = [2, 3, 5, 7]
+VIDITELNOST = [
+    "svitání/soumrak",
+    "zlé počasie cez den",
+    "věrejný osvětlení, noc, zlé počasie",
+    "žádné osvětlení, noc, zlé počasie",
+]
+
+
+@TRACER.instrument("load_data", rows=lambda result, *args, **kwargs: len(result[0]) + len(result[1]))
+def load_data(filename: str, regions: list = None, years: list = None):
     """This function handles loading of the dataset file and parsing chosen data"""
 
-    # loading of the dataset
-    df = pd.read_pickle(filename)
+    # loading of the dataset, only the studied columns and partitions of chosen regions and years are read
+    df = load_dataset(filename, ["p37", "p18", "p19"], regions=regions, years=years)
 
     # two new dataframes for better preservation of rows as there probably wont 
     # be many rows with None's in both cols
@@ -53,35 +84,11 @@ def process_data(data_weather: pd.DataFrame, data_visib: pd.DataFrame):
 
     # parse integer data to given labels
     print("Processing data...")
-    typ_silnice = [0, 100, 1000, np.inf]
-    names = [
-        "dálnice alebo cesta 1. triedy", 
-        "cesta 2. triedy", 
-        "cesta 3. triedy"
-    ]
-    data_weather["silnice"] = pd.cut(data_weather["p37"], typ_silnice, labels=names)
-    data_visib["silnice"] = pd.cut(data_visib["p37"], typ_silnice, labels=names)
-
-    pocasie_enum = [0, 2, 3, 4, 5, 6, 7]
-    pocasie = [
-        "jiné stížené",
-        "mlha",
-        "mrholení",
-        "déšť",
-        "sněžení",
-        "námraza",
-        "nárazový vítr",
-    ]
-    data_weather["Zle pocasie"] = data_weather["p18"].replace(pocasie_enum, pocasie)
-
-    viditelnost_enum = [2, 3, 5, 7]
-    viditelnost = [
-        "svitání/soumrak",
-        "zlé počasie cez den",
-        "věrejný osvětlení, noc, zlé počasie",
-        "žádné osvětlení, noc, zlé počasie",
-    ]
-    data_visib["Viditelnost"] = data_visib["p19"].replace(viditelnost_enum, viditelnost)
+    data_weather["silnice"] = pd.cut(data_weather["p37"], TYP_SILNICE, labels=SILNICE)
+    data_visib["silnice"] = pd.cut(data_visib["p37"], TYP_SILNICE, labels=SILNICE)
+
+    data_weather["Zle pocasie"] = data_weather["p18"].replace(POCASIE_ENUM, POCASIE)
+    data_visib["Viditelnost"] = data_visib["p19"].replace(VIDITELNOST_ENUM, VIDITELNOST)
 
     # group by data according to studied topic(weather, visibility)
     result1 = (
@@ -97,7 +104,63 @@ def process_data(data_weather: pd.DataFrame, data_visib: pd.DataFrame):
     )
     return result1, result2
 
-def plot_data(result1: pd.DataFrame, result2: pd.DataFrame):
+def parse_column(column: pd.Series) -> np.ndarray:
+    """ Column as float array, empty strings and missing values become NaN."""
+    return pd.to_numeric(column.replace("", np.nan)).to_numpy(dtype=np.float64)
+
+
+def filter_chunk(chunk: pd.DataFrame):
+    """ Selects rows of one chunk with the same rules as load_data, returns
+        (p18, p37) of bad weather records and (p19, p37) of bad visibility records."""
+    p37 = parse_column(chunk["p37"])
+    p18 = parse_column(chunk["p18"])
+    p19 = parse_column(chunk["p19"])
+    # comparisons with NaN are false, so missing values are dropped as well
+    road = p37 > 0
+    weather = road & (p18 > 1)
+    visib = road & (p19 > 1) & (p19 != 4) & (p19 != 6)
+    return (p18[weather], p37[weather]), (p19[visib], p37[visib])
+
+
+def count_chunk(values: np.ndarray, roads: np.ndarray) -> pd.Series:
+    """ Partial count of accidents by (condition value, road type code) in one chunk."""
+    codes = pd.cut(roads, TYP_SILNICE, labels=False)
+    return pd.DataFrame({"value": values.astype(np.int64), "silnice": codes.astype(np.int64)}).value_counts()
+
+
+def counts_table(counts: pd.Series, enum: list, labels: list, name: str) -> pd.DataFrame:
+    """ Table of merged partial counts grouped the same way as in process_data."""
+    data = pd.DataFrame({
+        name: pd.Series(counts.index.get_level_values("value"), dtype=np.int64).replace(enum, labels),
+        "silnice": pd.Categorical.from_codes(counts.index.get_level_values("silnice"), SILNICE, ordered=True),
+        "count": counts.to_numpy(dtype=np.int64),
+    })
+    return data.groupby([name, "silnice"])["count"].sum().reset_index(name="Počet nehôd")
+
+
+@TRACER.instrument("stream_data")
+def stream_data(filename: str, chunk_rows: int = CHUNK_ROWS, regions: list = None, years: list = None):
+    """ Streaming variant of load_data and process_data, the dataset is read
+        in chunks of chunk_rows rows, so memory use is bounded by the chunk size.
+        Returns the same result1 and result2 tables as process_data."""
+    print("Streaming data...")
+    chunks = iter_dataset(filename, ["p37", "p18", "p19"], regions, chunk_rows, years)
+    filtered = (filter_chunk(chunk) for chunk in chunks)
+    counted = ((count_chunk(*weather), count_chunk(*visib)) for weather, visib in filtered)
+
+    # partial counts are merged chunk by chunk, no matching row group gives empty tables
+    weather_counts = visib_counts = count_chunk(np.empty(0), np.empty(0))
+    for weather, visib in counted:
+        weather_counts = weather_counts.add(weather, fill_value=0)
+        visib_counts = visib_counts.add(visib, fill_value=0)
+
+    result1 = counts_table(weather_counts, POCASIE_ENUM, POCASIE, "Zle pocasie")
+    result2 = counts_table(visib_counts, VIDITELNOST_ENUM, VIDITELNOST, "Viditelnost")
+    return result1, result2
+
+
+@TRACER.instrument("plot_data", rows=input_rows)
+def plot_data(result1: pd.DataFrame, result2: pd.DataFrame, fig_location: str = "fig.png"):
     """ Function plots statistics of accidents based on visibility and weather
         at the time of the accident."""
     print("Plotting...")
@@ -140,7 +203,7 @@ def plot_data(result1: pd.DataFrame, result2: pd.DataFrame):
     axes[0].set_xlabel("")
 
     fig.tight_layout()
-    plt.savefig("fig.png")
+    fig.savefig(fig_location)
 
 def print_data(result1: pd.DataFrame, result2: pd.DataFrame):
     """Prints tables for plots and some interesting hand picked data."""
@@ -166,9 +229,9 @@ def print_data(result1: pd.DataFrame, result2: pd.DataFrame):
     )
 
 if __name__ == "__main__":
+    instrument.configure()
     main_folder = Path(__file__).parent.parent.resolve()
     print("Loading data...")
-    x, y = load_data(main_folder / "accidents.pkl.gz")
-    result1, result2 = process_data(x, y)
+    result1, result2 = stream_data(main_folder / "accidents.pkl.gz")
     plot_data(result1, result2)
     print_data(result1, result2)
@@ -1,22 +1,196 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import re
-import csv
 from bs4 import BeautifulSoup
 from os import path, listdir
 from os.path import isfile, join
 from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+import pandas as pd
 import gzip
 import pickle
 import io
-from io import BytesIO
+import json
+import shutil
+import zlib
 from pathlib import Path
+from colstore import write_columns, read_columns, read_manifest, append_columns, update_columns
+import instrument
+from instrument import TRACER, count_rows, output_rows
+
+# manifest of year partitions in the npy cache directory of a region
+PARTITIONS = 'partitions.json'
+# codes of dictionary encoded text columns
+CODE_TYPE = np.dtype('i4')
+# XX, A:/B:.., empty string values marking missing data
+NA_VALUES = ['', 'XX'] + [c + ':' for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']
+
+
+def normalize_column(column, dtype):
+    '''Vectorized conversion of a csv column of strings to dtype, missing data sentinels become -1.'''
+    if column.dtype.kind == 'f':
+        return column.fillna(-1).to_numpy().astype(dtype)
+    if dtype.kind in 'iuf':
+        if dtype.kind == 'f':
+            column = column.str.replace(',', '.', regex=False)
+        return pd.to_numeric(column, errors='coerce').fillna(-1).to_numpy().astype(dtype)
+    if dtype.kind == 'M':
+        dates = pd.to_datetime(column, format='%Y-%m-%d', errors='coerce').to_numpy().astype(dtype)
+        dates[np.isnat(dates)] = np.datetime64(-1, 'D')
+        return dates
+    values = column.to_numpy().astype(dtype)
+    chars = values.view(np.uint32).reshape(len(values), dtype.itemsize // 4)
+    chars[chars == ord(',')] = ord('.')
+    # empty string, two letters or a word character followed by a colon
+    first, second = chars[:, 0], chars[:, 1]
+    short = chars[:, 2] == 0 if chars.shape[1] > 2 else np.ones(len(values), dtype=bool)
+    word = char_test(first, lambda c: c.isalnum() or c == '_')
+    letters = char_test(first, str.isalpha) & char_test(second, str.isalpha)
+    values[short & ((first == 0) | letters | (word & (second == ord(':'))))] = '-1'
+    return values
+
+
+def char_test(codes, test):
+    '''Vectorized str test of single characters given by their unicode codes.'''
+    unique, inverse = np.unique(codes, return_inverse=True)
+    return np.array([test(chr(code)) for code in unique], dtype=bool)[inverse]
+
+
+class Vocabulary:
+    '''Distinct strings of one dictionary encoded column, a code is the position of its string.
+    Strings are only appended, so codes given out stay valid.'''
+
+    def __init__(self, values=()):
+        self.values = []
+        self.index = {}
+        self.decoder = np.empty(0, dtype=str)
+        self.remap(values)
+
+    def code(self, value):
+        '''Code of one string, an unseen string is appended.'''
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def remap(self, values):
+        '''Codes of the vocabulary values of another encoding, indexed by their old codes.'''
+        return np.array([self.code(str(value)) for value in values], dtype=CODE_TYPE)
+
+    def encode(self, strings):
+        '''Codes of an array of strings, every distinct string is looked up once.'''
+        unique, inverse = np.unique(np.asarray(strings), return_inverse=True)
+        return self.remap(unique)[inverse.reshape(-1)]
+
+    def decode(self, codes):
+        '''Strings of the codes (or of a categorical over the values), the lookup array is rebuilt only
+        after new strings were added.'''
+        if len(self.decoder) != len(self.values):
+            self.decoder = np.array(self.values, dtype=str)
+        return self.decoder[np.asarray(getattr(codes, 'codes', codes))]
+
+    def used(self, codes):
+        '''Values up to the highest of the codes, the part of the vocabulary needed to decode them.'''
+        return self.values[:int(np.max(codes)) + 1] if len(codes) else []
+
+
+def as_array(data, dtype):
+    '''Converts dict of columns or legacy list of per row arrays to one structured ndarray.'''
+    if isinstance(data, np.ndarray):
+        return data
+    if isinstance(data, dict):
+        array = np.empty(len(data[dtype.names[0]]), dtype=dtype)
+        for name in dtype.names:
+            array[name] = data[name]
+        return array
+    return np.array(data, dtype=dtype).reshape(-1)
+
+
+def concatenate(arrays, dtype):
+    '''Concatenates region arrays or columns, a single array is returned without copying.'''
+    if len(arrays) == 1:
+        return arrays[0]
+    if not arrays:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+def take_rows(data, rows):
+    '''Rows of a structured array or of a dict of columns.'''
+    if isinstance(data, dict):
+        return {name: column[rows] for name, column in data.items()}
+    return data[rows]
+
+
+def select_years(data, years):
+    '''Rows of data dated in one of the years (all rows if None), nothing is copied when every row matches.'''
+    if years is None:
+        return data
+    dates = np.asarray(data['f5'])
+    matches = np.isin(dates.astype('datetime64[Y]').astype(np.int64) + 1970, [int(year) for year in years])
+    return data if matches.all() else take_rows(data, np.flatnonzero(matches))
+
+
+def partition_matches(partition, years):
+    '''Whether the year partition can hold rows of the years, decided by its min/max dates.'''
+    if years is None:
+        return True
+    if not partition.get('date_min'):
+        return False
+    first, last = int(partition['date_min'][:4]), int(partition['date_max'][:4])
+    return any(first <= int(year) <= last for year in years)
+
+
+def parse_region_job(settings, members, region):
+    '''Process pool job, parses one region straight from its archive members and saves its cache.
+    Memory mapped npy cache is reopened by the caller, pickled data is returned together with spans of the worker.'''
+    downloader = DataDownloader(**settings)
+    downloader.index = {region: members}
+    data = downloader.parse_region_data(region)[1]
+    downloader.cache[region] = data
+    downloader.save_cache(region)
+    # codes of the worker are translated to the vocabulary of the caller
+    return ((data, downloader.used_vocab(data)) if downloader.cache_backend == 'pickle' else None), TRACER.drain()
+
+
+def parse_partition_job(settings, member, region):
+    '''Executor job, parses one (archive, member, year) csv of the region and writes its year partition
+    of the npy cache. Returns the partition manifest entry together with spans of the worker.'''
+    downloader = DataDownloader(**settings)
+    data, slices = downloader.parse_members(region, [member])
+    partitions = downloader.write_partitions(region, data, slices)
+    return partitions[str(member[2])], TRACER.drain()
+
+
+COOKIES = {
+    '_ranaCid': '207473589.1568325762',
+    '_ga': 'GA1.2.789520775.1568325762',
+    '_fbp': 'fb.1.1601117742080.263834980',
+    '_gcl_au': '1.1.1395316238.1603826617',
+    '_gid': 'GA1.2.1350174918.1604404951',
+}
+
+HEADERS = {
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.111 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
+    'Sec-Fetch-Site': 'same-origin',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-User': '?1',
+    'Sec-Fetch-Dest': 'document',
+    'Referer': 'https://ehw.fit.vutbr.cz/izv/',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
 
 
 class DataDownloader:
 
     def __init__(self, url="https://ehw.fit.vutbr.cz/izv/", folder="data", cache_filename="data_{}.pkl.gz",
+                 cache_dirname="region={}", cache_backend="npy",
                  regions={
                      'PHA': '00',
                      'STC': '01',
@@ -36,29 +210,75 @@ class DataDownloader:
         self.url = url
         main_folder = Path(__file__).parent.parent.resolve()
         self.folder = main_folder / folder
+        # aggregates built from the accident data (cube of analysis.get_cube), removed once refresh changes
+        # cached rows so they are rebuilt on next use instead of staying stale
+        self.aggregates = [main_folder / "accidents.cube.pkl"]
         self.cache_filename = cache_filename
+        self.cache_dirname = cache_dirname
+        # 'npy' stores memory mapped columns partitioned by year, 'pickle' gzip pickled arrays
+        if cache_backend not in ('npy', 'pickle'):
+            raise ValueError("Unknown cache backend %s" % cache_backend)
+        self.cache_backend = cache_backend
         self.regions = regions
         self.data_files = []
         self.cache = {}
+        # region -> {year: archive, member, content hash and rows of the year in region data}
+        self.slices = {}
         self.zips = []
+        self.session = None
+        # parallel archive downloads, streamed in chunks of bytes, timeout in seconds
+        self.download_workers = 4
+        self.download_chunk = 1024 * 1024
+        self.download_timeout = 60
+        # opened archives by file name and region -> [(archive, member, year)] index of their csv files
+        self.archives = {}
+        self.index = {}
         self.col_list = ['f1', 'f2', 'f3', 'f5', 'f6', 'f7', 'f8', 'f9',
                          'f10', 'f11', 'f12', 'f13', 'f14', 'f15', 'f16', 'f17', 'f18', 'f19', 'f20', 'f21', 'f22',
                          'f23', 'f24', 'f25', 'f26', 'f27', 'f28', 'f29', 'f30', 'f31', 'f32', 'f33', 'f34', 'f35',
                          'f36', 'f37', 'f38', 'f39', 'f40', 'f41', 'f42', 'f43', 'f44', 'f45', 'f46', 'f47', 'f48',
                          'f49', 'f50', 'f51', 'f52', 'f53', 'f54',
                          'f55', 'f56', 'f57', 'f58', 'f59', 'f60', 'f61', 'f62', 'f63', 'f64', 'f65', 'f66']
+        # datatype for given columns in csv files
+        self.csv_dtype = np.dtype([('f1', 'i8'), ('f2', 'i'), ('f3', 'i2'), ('f5', 'datetime64[D]'), ('f6', 'i'), ('f7', 'i2'),
+                                ('f8', 'i'), ('f9', 'i'), ('f10', 'i'), ('f11', 'i'), ('f12', 'i2'), ('f13', 'i'),
+                                ('f14', 'i4'), ('f15', 'i2'), ('f16', 'i2'), ('f17', 'i2'), ('f18', 'i4'), ('f19', 'i'),
+                                ('f20', 'i'), ('f21', 'i'), ('f22', 'i'), ('f23', 'i'), ('f24', 'i'), ('f25', 'i'),
+                                ('f26', 'i'), ('f27', 'i'), ('f28', 'i'), ('f29', 'i2'), ('f30', 'i'), ('f31', 'i2'),
+                                ('f32', 'i2'), ('f33', 'i'), ('f34', 'i'), ('f35', 'i4'), ('f36', 'i2'), ('f37', 'i'),
+                                ('f38', 'i'), ('f39', 'i'), ('f40', 'i'), ('f41', 'i'), ('f42', 'i'), ('f43', 'i'),
+                                ('f44', 'i'), ('f45', 'i'), ('f46', 'i'), ('f47', 'd'), ('f48', 'd'), ('f49', 'd'),
+                                ('f50', 'd'), ('f51', 'd'), ('f52', 'd'), ('f53', 'U25'), ('f54', 'U25'), ('f55', 'i'),
+                                ('f56', 'U25'), ('f57', 'U10'), ('f58', 'U25'), ('f59', 'd'), ('f60', 'U25'),
+                                ('f61', 'U25'), ('f62', 'i8'), ('f63', 'i8'), ('f64', 'U25'), ('f65', 'i'), ('f66', 'U25')])
+        # text columns are dictionary encoded, rows hold codes of the vocabulary of the column and strings
+        # are decoded only on demand, region codes of f66 come in the order of regions
+        self.text_types = {name: self.csv_dtype[name] for name in self.col_list if self.csv_dtype[name].kind == 'U'}
+        self.d_type = np.dtype([(name, CODE_TYPE if name in self.text_types else self.csv_dtype[name])
+                                for name in self.col_list])
+        self.vocab = {name: Vocabulary(regions.keys() if name == 'f66' else ()) for name in self.text_types}
+        # numeric columns are parsed by the csv reader itself, sentinels are read as NaN
+        numeric = [name for name in self.col_list[:-1] if self.csv_dtype[name].kind in 'iuf']
+        self.csv_types = {name: 'float64' if name in numeric else str for name in self.col_list[:-1]}
+        self.csv_na_values = {name: NA_VALUES for name in numeric}
+        # number of csv rows converted at once, bounds the memory used by intermediate strings
+        self.chunk_rows = 16384
 
         if not path.isdir(self.folder):
             try:
                 print("Creating directory...")
-                os.mkdir(folder)
+                os.makedirs(self.folder)
             except OSError:
                 print("Creation of the directory %s failed" % path)
 
-    def save_zip_file(self, filename, response):
-        '''Writes the zip data to a file.'''
-        with open(filename, 'wb') as fd:
-            fd.write(response.content)
+    def save_zip_file(self, filename, response, mode='wb', progress=None):
+        '''Streams the zip data to a file in chunks, the whole archive is never held in memory.
+        progress(bytes) is called after every written chunk if given.'''
+        with open(filename, mode) as fd:
+            for chunk in response.iter_content(chunk_size=self.download_chunk):
+                fd.write(chunk)
+                if progress is not None:
+                    progress(len(chunk))
 
     def find_latest_zips(self, files):
         '''Searching the most recent file for every year.'''
@@ -74,95 +294,371 @@ class DataDownloader:
             past_year = present_year
             past_file = file
 
+    def open_session(self):
+        '''One pooled http session shared by all downloads.'''
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.headers.update(HEADERS)
+            self.session.cookies.update(COOKIES)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.download_workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
+    def fetch_archive(self, file, progress=None):
+        '''Downloads one archive to the data folder, returns 'downloaded', 'resumed' or 'not modified'.
+
+        Partially downloaded archive is resumed by a range request, complete archive is requested
+        conditionally with its stored ETag/Last-Modified and kept if the server answers 304.'''
+        filename = self.folder / Path(file).name
+        partial = filename.with_name(filename.name + ".part")
+        meta_file = filename.with_name(filename.name + ".meta.json")
+        meta = {}
+        if path.isfile(meta_file):
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+        validator = meta.get('etag') or meta.get('last_modified')
+        headers = {}
+        if path.isfile(partial) and validator:
+            headers['Range'] = 'bytes=%d-' % path.getsize(partial)
+            headers['If-Range'] = validator
+        elif path.isfile(filename):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with self.open_session().get(self.url + file, headers=headers, stream=True, timeout=self.download_timeout) as r:
+            if r.status_code == 304:
+                return 'not modified'
+            r.raise_for_status()
+            resumed = r.status_code == 206
+            meta = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+            # validators are stored before the body so an interrupted download can be resumed
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+            self.save_zip_file(partial, r, 'ab' if resumed else 'wb', progress)
+        os.replace(partial, filename)
+        return 'resumed' if resumed else 'downloaded'
+
+    @TRACER.instrument("download_data")
     def download_data(self):
-        '''Downloads all latest zip files or loads data from data folder.'''
-        cookies = {
-            '_ranaCid': '207473589.1568325762',
-            '_ga': 'GA1.2.789520775.1568325762',
-            '_fbp': 'fb.1.1601117742080.263834980',
-            '_gcl_au': '1.1.1395316238.1603826617',
-            '_gid': 'GA1.2.1350174918.1604404951',
-        }
-
-        headers = {
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.111 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
-            'Sec-Fetch-Site': 'same-origin',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-User': '?1',
-            'Sec-Fetch-Dest': 'document',
-            'Referer': 'https://ehw.fit.vutbr.cz/izv/',
-            'Accept-Language': 'en-US,en;q=0.9',
-        }
+        '''Downloads all latest zip files in parallel or loads data from data folder.'''
+        self.list_archives()
+
+        # requesting files and saving them to folder, unchanged files are skipped
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.download_workers) as pool:
+            for file, status in zip(self.data_files, pool.map(self.fetch_archive, self.data_files)):
+                print("%s: %s" % (file, status))
+        self.open_archives([self.folder / Path(file).name for file in self.data_files])
 
+    def list_archives(self):
+        '''Latest zip file of every year linked from the sites html, nothing gets downloaded.'''
         # request sites html and parsing all available links with zip data files
-        response = requests.get(self.url, headers=headers, cookies=cookies)
+        response = self.open_session().get(self.url, timeout=self.download_timeout)
         soup = BeautifulSoup(response.text, 'html.parser')
         files = [a['href'] for a in soup.find_all("a", class_="btn-primary")]
+        self.data_files = []
         self.find_latest_zips(files)
+        return self.data_files
+
+    def open_archives(self, files):
+        '''Opens zip archives and indexes their region csv members, archives are never rescanned afterwards.
+        The index is rebuilt on every call, members of archives opened by an earlier download are not listed twice.'''
+        self.index = {}
+        for file in files:
+            for region, member in self.index_archive(file):
+                self.index.setdefault(region, []).append(member)
+
+    def index_archive(self, file):
+        '''Opens one zip archive, returns (region, (archive, member, year)) of its region csv members.'''
+        codes = {code: region for region, code in self.regions.items()}
+        zipfile = ZipFile(file, 'r')
+        # an archive opened again (a newer snapshot downloaded under the same name) replaces the old handle
+        previous = self.archives.get(str(file))
+        if previous is not None:
+            self.zips = [z for z in self.zips if z is not previous]
+            previous.close()
+        self.zips.append(zipfile)
+        self.archives[str(file)] = zipfile
+        year = re.search(r"([0-9]{4})\.zip$", str(file))
+        return [(codes[name[:-4]], (str(file), name, int(year.group(1)) if year else None))
+                for name in zipfile.namelist() if name[:-4] in codes]
 
-        # requesting files and saving them to folder, if already saved, just load them
-        for file in self.data_files:
-            url = self.url + file
-            if not path.isfile(file):
-                r = requests.get(url, headers=headers,
-                                 cookies=cookies, stream=True)
-                self.save_zip_file(file, r)
-                zipfile = ZipFile(BytesIO(r.content))
-                self.zips.append(zipfile)
-            else:
-                zipfile = ZipFile(file, 'r')
-                self.zips.append(zipfile)
+    def available(self):
+        '''Years available for every region in opened archives, nothing gets parsed.'''
+        return {region: [year for _, _, year in self.index.get(region, [])] for region in self.regions.keys()}
 
+    def open_archive(self, archive):
+        '''Opened zip archive, the archive is opened once on first use.'''
+        if archive not in self.archives:
+            self.archives[archive] = ZipFile(archive, 'r')
+        return self.archives[archive]
+
+    def read_member(self, archive, member):
+        '''Reads archive member.'''
+        return self.open_archive(archive).read(member)
+
+    def member_hash(self, archive, member):
+        '''Content hash of archive member taken from the zip directory, nothing gets decompressed.'''
+        info = self.open_archive(archive).getinfo(member)
+        return "%08x-%d" % (info.CRC, info.file_size)
+
+    @TRACER.instrument("parse_region_data", rows=output_rows, attrs=lambda self, region: {'region': region})
     def parse_region_data(self, region):
-        '''Parses csv files, converts rows in csv to ndarray with correct datatypes, return column names and list of aforementioned ndarrays.'''
+        '''Parses csv files of the region, return column names and one structured ndarray with correct datatypes.'''
         if region in self.regions.keys():
             # in case the data is not downloaded or loaded
-            if(not self.zips):
+            if(not self.index):
                 self.download_data()
-            # datatype for given columns in csv files
-            d_type = np.dtype([('f1', 'i8'), ('f2', 'i'), ('f3', 'i2'), ('f5', 'datetime64[D]'), ('f6', 'i'), ('f7', 'i2'), ('f8', 'i'), ('f9', 'i'),
-                               ('f10', 'i'), ('f11', 'i'), ('f12', 'i2'), ('f13', 'i'), ('f14',
-                                                                                         'i4'), ('f15', 'i2'), ('f16', 'i2'), ('f17', 'i2'), ('f18', 'i4'),
-                               ('f19', 'i'), ('f20', 'i'), ('f21', 'i'), ('f22', 'i'), ('f23',
-                                                                                        'i'), ('f24', 'i'), ('f25', 'i'), ('f26', 'i'), ('f27', 'i'),
-                               ('f28', 'i'), ('f29', 'i2'), ('f30', 'i'), ('f31', 'i2'), ('f32',
-                                                                                          'i2'), ('f33', 'i'), ('f34', 'i'), ('f35', 'i4'), ('f36', 'i2'),
-                               ('f37', 'i'), ('f38', 'i'), ('f39', 'i'), ('f40', 'i'), ('f41',
-                                                                                        'i'), ('f42', 'i'), ('f43', 'i'), ('f44', 'i'), ('f45', 'i'),
-                               ('f46', 'i'), ('f47', 'd'), ('f48', 'd'), ('f49', 'd'), ('f50',
-                                                                                        'd'), ('f51', 'd'), ('f52', 'd'), ('f53', 'U25'), ('f54', 'U25'),
-                               ('f55', 'i'), ('f56', 'U25'), ('f57', 'U10'), ('f58', 'U25'), ('f59',
-                                                                                              'd'), ('f60', 'U25'), ('f61', 'U25'), ('f62', 'i8'), ('f63', 'i8'),
-                               ('f64', 'U25'), ('f65', 'i'), ('f66', 'U25')])
-
-
-            nplist = []
-            # regex for XX, A:/B:.., empty string elimination
-            regex = r"^(\w:|\w\w|)$"
-            # processes rows in csv files to ndarrays with appropriate datatypes
-            for z in self.zips:
-                for name in z.namelist():
-                    if name[:-4] == self.regions.get(region):
-                        content = io.TextIOWrapper(
-                            z.open(name), encoding='windows-1250', newline='')
-                        data_iter = csv.reader(
-                            content, delimiter=';', quotechar='"')
-                        for data in data_iter:
-                            a = tuple(
-                                "-1" if re.match(regex, x) else x.replace(',', '.') for x in data) + (region,)
-                            nplist.append(np.asarray(a, dtype=d_type))
-            return self.col_list, nplist
+            data, self.slices[region] = self.parse_members(region, self.index.get(region, []))
+            return self.col_list, data
+
+    def parse_members(self, region, members):
+        '''Parses (archive, member, year) csv files of the region into one ndarray, returns it with rows of every year.'''
+        raws = [self.read_member(archive, member) for archive, member, _ in members]
+        # upper bound of the row count, the array gets trimmed after parsing
+        data = np.empty(sum(raw.count(b'\n') + 1 for raw in raws), dtype=self.d_type)
+        filled = 0
+        slices = {}
+        for archive, member, year in members:
+            start = filled
+            raw = raws.pop(0)
+            with TRACER.span("parse_member", region=region, archive=Path(archive).name, member=member) as span:
+                filled = self.parse_csv(raw, region, data, filled)
+                span.rows = filled - start
+            # length and checksum of the parsed csv, a later snapshot of the year is parsed only behind them
+            slices[str(year)] = dict(archive=Path(archive).name, member=member,
+                                     hash=self.member_hash(archive, member), bytes=len(raw), crc=zlib.crc32(raw),
+                                     start=start, stop=filled)
+        return data[:filled], slices
+
+    def refresh(self, regions=None, incremental=False):
+        '''Reparses only the years of regions whose source archive or its content changed and rewrites their
+        partitions of the npy cache, unchanged partitions are kept. Pickle cache regions are reparsed whole.
+
+        In incremental mode a newer snapshot of a cached year (monthly archives hold the year so far) is parsed
+        only behind the already cached part of its csv. Its rows with accident ids f1 missing in the partition
+        are appended to it, rows of cached ids replace them. A year is reparsed when the cached part changed.
+        Returns region -> columns of the appended rows (as get_list 'columns' gives them) to be added
+        to counts of get_stat (add_accident_stats). Files of self.aggregates are removed when any rows changed.'''
+        if(not self.index):
+            self.download_data()
+        if regions is None:
+            regions = self.regions.keys()
+        if(type(regions) == str):
+            regions = [regions]
+        appended = {}
+        changed = False
+        for region in regions:
+            members = self.index.get(region, [])
+            if self.cache_backend != 'npy' or self.search_cache_file(region) is False:
+                changed = True
+                self.cache[region] = self.parse_region_data(region)[1]
+                self.save_cache(region)
+                continue
+            cached = self.read_partitions(region)
+            stale = [(archive, member, year) for archive, member, year in members
+                     if cached.get(str(year), {}).get('archive') != Path(archive).name
+                     or cached.get(str(year), {}).get('hash') != self.member_hash(archive, member)]
+            if not stale and set(cached.keys()) == {str(year) for _, _, year in members}:
+                print("%s: up to date" % region)
+                continue
+            changed = True
+            if incremental:
+                parts = []
+                for archive, member, year in list(stale):
+                    if str(year) not in cached:
+                        continue
+                    result = self.append_member(region, (archive, member, year), cached[str(year)])
+                    if result is None:
+                        continue
+                    cached[str(year)], rows, changed = result
+                    parts.append(rows)
+                    stale.remove((archive, member, year))
+                    print("%s: appended %d rows to %s, %d changed" % (region, len(rows['f1']), year, changed))
+                appended[region] = self.categorical({name: concatenate([part[name] for part in parts],
+                                                                       self.d_type[name]) for name in self.col_list})
+            if stale:
+                print("%s: reparsing %s" % (region, ", ".join(str(year) for _, _, year in stale)))
+            fresh, fresh_slices = self.parse_members(region, stale)
+            written = self.write_partitions(region, fresh, fresh_slices)
+            self.write_partition_manifest(region, {str(year): written.get(str(year)) or cached[str(year)]
+                                                   for _, _, year in members})
+            self.cache[region] = self.load_cache(region)
+        if changed:
+            self.remove_aggregates()
+        return appended
 
+    def remove_aggregates(self):
+        '''Removes aggregates built from the accident data, they are rebuilt from the data on next use.'''
+        for filename in self.aggregates:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def append_member(self, region, member, partition):
+        '''Parses the csv of a newer snapshot of the year partition only behind its cached part and writes the new
+        rows into the partition. Returns the updated manifest entry, the appended rows and the number of changed
+        rows, None when the cached part of the csv differs and the year has to be reparsed.'''
+        archive, name, year = member
+        raw = self.read_member(archive, name)
+        cached = partition.get('bytes')
+        if cached is None or len(raw) < cached or zlib.crc32(memoryview(raw)[:cached]) != partition['crc']:
+            return None
+        tail = np.empty(raw.count(b'\n', cached) + 1, dtype=self.d_type)
+        with TRACER.span("parse_member", region=region, archive=Path(archive).name, member=name) as span:
+            tail = tail[:self.parse_csv(raw[cached:], region, tail)]
+            span.rows = len(tail)
+        directory = self.folder / self.cache_dirname.format(region) / partition['path']
+        # text columns are stored with codes of the partition vocabulary
+        vocab = {key: Vocabulary(partition.get('vocab', {}).get(key, [])) for key in self.vocab}
+        columns = {key: vocab[key].encode(self.vocab[key].decode(tail[key])) if key in vocab else tail[key]
+                   for key in self.col_list}
+        if {key: np.dtype(dtype) for key, dtype in read_manifest(directory)['dtype']} != \
+                {key: column.dtype for key, column in columns.items()}:
+            # partition stored in an older layout
+            return None
+        # accidents already in the partition are corrections of their rows, only the other ones are new;
+        # ids above the largest cached one are new without searching the f1 column of the partition
+        if 'f1_max' in partition:
+            f1_max = partition['f1_max']
+        else:
+            ids = read_columns(directory, ['f1'])['f1']
+            f1_max = int(ids.max()) if len(ids) else None
+        known = np.zeros(len(tail), dtype=bool)
+        candidates = np.flatnonzero(tail['f1'] <= f1_max) if f1_max is not None else np.empty(0, dtype=np.int64)
+        if len(candidates):
+            ids = read_columns(directory, ['f1'])['f1']
+            order = np.argsort(ids, kind='stable')
+            found = np.searchsorted(ids, tail['f1'][candidates], sorter=order).clip(0, len(ids) - 1)
+            hit = ids[order[found]] == tail['f1'][candidates]
+            known[candidates[hit]] = True
+            if hit.any():
+                update_columns(directory, order[found[hit]], {key: column[known] for key, column in columns.items()})
+        append_columns(directory, {key: column[~known] for key, column in columns.items()})
+        dates = tail['f5'][tail['f5'] != np.datetime64(-1, 'D')]
+        # date bounds only widen, they stay valid for pruning after corrections
+        bounds = [np.datetime64(partition[key]) for key in ('date_min', 'date_max') if partition.get(key)]
+        dates = np.concatenate([dates, np.array(bounds, dtype=dates.dtype)])
+        maxima = [value for value in (f1_max, int(tail['f1'].max()) if len(tail) else None) if value is not None]
+        entry = dict(partition, archive=Path(archive).name, member=name, hash=self.member_hash(archive, name),
+                     bytes=len(raw), crc=zlib.crc32(raw), rows=partition['rows'] + int((~known).sum()),
+                     date_min=str(dates.min()) if len(dates) else None,
+                     date_max=str(dates.max()) if len(dates) else None,
+                     f1_max=max(maxima) if maxima else None,
+                     vocab={key: vocabulary.values for key, vocabulary in vocab.items()})
+        return entry, take_rows({key: tail[key] for key in self.col_list}, ~known), int(known.sum())
+
+    def parse_csv(self, raw, region, out, start=0):
+        '''Parses one region csv straight into out[start:], returns index after last parsed row.'''
+        if not raw.strip():
+            return start
+        try:
+            return self.fill_rows(raw, region, out, start, self.csv_types)
+        except ValueError:
+            # unexpected value in a numeric column, everything is read as strings and coerced
+            return self.fill_rows(raw, region, out, start, str)
+
+    def fill_rows(self, raw, region, out, start, csv_types):
+        '''Reads csv in chunks of rows and converts its columns to the structured datatype.'''
+        reader = pd.read_csv(io.BytesIO(raw), sep=';', quotechar='"', header=None, names=self.col_list[:-1],
+                             dtype=csv_types, na_values=self.csv_na_values, keep_default_na=False, decimal=',',
+                             encoding='windows-1250', chunksize=self.chunk_rows)
+        for chunk in reader:
+            stop = start + len(chunk)
+            block = out[start:stop]
+            for name in self.col_list[:-1]:
+                if name in self.text_types:
+                    block[name] = self.vocab[name].encode(normalize_column(chunk[name], self.text_types[name]))
+                else:
+                    block[name] = normalize_column(chunk[name], self.d_type[name])
+            block['f66'] = self.vocab['f66'].code(region)
+            start = stop
+        return start
+
+    @TRACER.instrument("save_cache", rows=lambda result, self, region: count_rows(self.cache.get(region)),
+                       attrs=lambda self, region: {'region': region})
     def save_cache(self, region):
-        '''Save cache locally.'''
-        with gzip.open(self.folder / self.cache_filename.format(region), 'wb') as f:
-            pickle.dump(self.cache.get(region), f, pickle.HIGHEST_PROTOCOL)
+        '''Save cache locally, npy cache is written as one column directory per year.'''
+        if self.cache_backend == 'npy':
+            data = self.cache.get(region)
+            slices = self.slices.get(region)
+            if not slices:
+                # data not parsed by this downloader, rows are grouped by their year
+                years = np.asarray(data['f5']).astype('datetime64[Y]').astype(np.int64) + 1970
+                order = np.argsort(years, kind='stable')
+                data, years = take_rows(data, order), years[order]
+                bounds = np.flatnonzero(np.diff(years)) + 1
+                slices = {str(years[start]): dict(start=int(start), stop=int(stop)) for start, stop in
+                          zip(np.append(0, bounds), np.append(bounds, len(years))) if stop > start}
+            self.write_partition_manifest(region, self.write_partitions(region, data, slices))
+            return
+        filename = self.folder / self.cache_filename.format(region)
+        # written aside and renamed, parallel workers never leave a half written cache
+        tmp = filename.with_name("%s.%d.tmp" % (filename.name, os.getpid()))
+        data = self.cache.get(region)
+        with gzip.open(tmp, 'wb') as f:
+            pickle.dump({'data': data, 'vocab': self.used_vocab(data)}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
+    def write_partitions(self, region, data, slices):
+        '''Writes rows of every year slice of the region data to its partition, returns manifest entries of them.'''
+        directory = self.folder / self.cache_dirname.format(region)
+        partitions = {}
+        for year, part in slices.items():
+            columns = {name: data[name][part['start']:part['stop']] for name in self.col_list}
+            path = 'year=%s' % year
+            write_columns(directory / path, columns, region=region, year=year)
+            dates = columns['f5'][columns['f5'] != np.datetime64(-1, 'D')]
+            partitions[year] = dict({key: value for key, value in part.items() if key not in ('start', 'stop')},
+                                    path=path, rows=part['stop'] - part['start'], vocab=self.used_vocab(columns),
+                                    date_min=str(dates.min()) if len(dates) else None,
+                                    date_max=str(dates.max()) if len(dates) else None,
+                                    f1_max=int(columns['f1'].max()) if len(columns['f1']) else None)
+        return partitions
+
+    def write_partition_manifest(self, region, partitions):
+        '''Replaces the partition manifest of the region, partitions missing in it are removed.'''
+        directory = self.folder / self.cache_dirname.format(region)
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp = directory / ('.%s.%d.tmp' % (PARTITIONS, os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump({'region': region, 'partitions': partitions}, f)
+        os.replace(tmp, directory / PARTITIONS)
+        paths = {part['path'] for part in partitions.values()}
+        for entry in os.scandir(directory):
+            if entry.is_dir() and entry.name.startswith('year=') and entry.name not in paths:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def read_partitions(self, region):
+        '''Partition manifest of the region npy cache: year -> path, source member, hash, rows and min/max dates.'''
+        with open(self.folder / self.cache_dirname.format(region) / PARTITIONS, 'r') as f:
+            return json.load(f)['partitions']
 
-    def load_cache(self, region):
-        '''Load cache from local storage.'''
+    @TRACER.instrument("load_cache", rows=output_rows,
+                       attrs=lambda self, region, years=None: {'region': region, 'years': years})
+    def load_cache(self, region, years=None):
+        '''Load cache from local storage, npy columns are only memory mapped and partitions
+        of other years than the requested ones (all if None) are not opened.'''
+        if self.cache_backend == 'npy':
+            directory = self.folder / self.cache_dirname.format(region)
+            partitions = self.read_partitions(region)
+            selected = [year for year, part in partitions.items() if partition_matches(part, years)]
+            parts = [select_years(self.adopt(read_columns(directory / partitions[year]['path']),
+                                             partitions[year].get('vocab', {})), years) for year in selected]
+            if years is None:
+                # rows of every year, kept for saving the region again
+                bounds = np.cumsum([0] + [partitions[year]['rows'] for year in selected])
+                self.slices[region] = {year: dict({key: value for key, value in partitions[year].items()
+                                                   if key in ('archive', 'member', 'hash', 'bytes', 'crc')},
+                                                  start=int(bounds[i]), stop=int(bounds[i + 1]))
+                                       for i, year in enumerate(selected)}
+            if len(parts) == 1:
+                return parts[0]
+            return {name: concatenate([part[name] for part in parts], self.d_type[name]) for name in self.col_list}
         with gzip.open(self.folder / self.cache_filename.format(region), 'rb') as f:
             try:
                 while f.read(1024 * 1024):
@@ -171,45 +667,133 @@ class DataDownloader:
                 print("Corrupted cache gzip file!")
                 exit(1)
             f.seek(0)
-            return pickle.load(f)
+            cached = pickle.load(f)
+        if isinstance(cached, dict) and 'vocab' in cached:
+            return self.adopt(cached['data'], cached['vocab'])
+        # cache of text columns stored as strings
+        return self.adopt(np.array(cached).reshape(-1) if isinstance(cached, list) else cached, {})
+
+    def used_vocab(self, data):
+        '''Vocabularies needed to decode text columns of the data, stored next to the data in the cache.'''
+        return {name: vocabulary.used(data[name]) for name, vocabulary in self.vocab.items()}
+
+    def adopt(self, data, vocab):
+        '''Translates text columns of data encoded by the vocab (or still holding strings) to codes of this
+        downloader. Nothing is copied when the codes already match.'''
+        columns = {}
+        for name, vocabulary in self.vocab.items():
+            column = data[name]
+            if column.dtype.kind == 'U':
+                columns[name] = vocabulary.encode(column)
+                continue
+            codes = vocabulary.remap(vocab.get(name, []))
+            if not np.array_equal(codes, np.arange(len(codes))):
+                columns[name] = codes[column]
+        if not columns:
+            return data
+        return dict({name: data[name] for name in self.col_list}, **columns)
+
+    def decode(self, name, codes):
+        '''Strings of a text column given by its codes, other columns are returned as they are.'''
+        if name not in self.vocab:
+            return codes
+        return self.vocab[name].decode(codes)
+
+    def categorical(self, columns):
+        '''Columns with text columns as categoricals over their vocabulary, strings are decoded on access.'''
+        return dict(columns, **{name: pd.Categorical.from_codes(columns[name], vocabulary.values)
+                                for name, vocabulary in self.vocab.items()})
+
+    def decoded(self, data):
+        '''Structured array of data with strings in text columns, the datatype of the csv files.'''
+        array = np.empty(len(data[self.col_list[0]]), dtype=self.csv_dtype)
+        for name in self.col_list:
+            array[name] = self.decode(name, data[name])
+        return array
 
     def search_cache_file(self, region):
         '''Looks for cache file in data folder'''
-        files_and_directories = os.listdir("data")
-        if self.cache_filename.format(region) in files_and_directories:
-            return True
-        return False
+        if self.cache_backend == 'npy':
+            return path.isfile(self.folder / self.cache_dirname.format(region) / PARTITIONS)
+        return path.isfile(self.folder / self.cache_filename.format(region))
+
+    def settings(self):
+        '''Constructor arguments recreating this downloader in a worker process.'''
+        return dict(url=self.url, folder=self.folder, cache_filename=self.cache_filename,
+                    cache_dirname=self.cache_dirname, cache_backend=self.cache_backend, regions=self.regions)
+
+    def parse_parallel(self, regions, workers):
+        '''Parses regions in a process pool, every worker opens the archive members and saves the region cache itself.'''
+        if(not self.index):
+            self.download_data()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = {region: pool.submit(parse_region_job, self.settings(), self.index.get(region, []), region)
+                    for region in regions}
+            # results are collected in the order of regions, not in the order of completion
+            for region in regions:
+                result, spans = jobs[region].result()
+                TRACER.merge(spans)
+                self.cache[region] = self.load_cache(region) if result is None else self.adopt(*result)
 
-    def get_list(self, regions=None):
-        '''processes all specified regions '''
+    def get_list(self, regions=None, output='list', workers=None, years=None):
+        '''processes all specified regions, output is one structured 'array', dict of 'columns' or legacy 'list' of rows,
+        regions missing in cache are parsed by a pool of workers processes if given, only rows of the years
+        are returned if given and other year partitions of the npy cache are not read.
+        Text columns of 'columns' are categoricals decoded on access, 'array' and 'list' keep the former
+        datatype with strings in text columns (see decoded)'''
+        if isinstance(years, (int, str)):
+            years = [years]
+        if output not in ('list', 'array', 'columns'):
+            raise ValueError("Unknown output type %s" % output)
         if regions is None:
             regions = self.regions.keys()
-        nplist = []
+        arrays = []
         # in case only one region was passed as a string
         if(type(regions) == str):
             regions = [regions]
+        if workers is not None and workers > 1:
+            missing = [region for region in regions if region in self.regions.keys()
+                       and region not in self.cache.keys() and self.search_cache_file(region) is False]
+            if len(missing) > 1:
+                self.parse_parallel(missing, workers)
         # loads data from cache or asks for missing data from parse_region_data
         for region in regions:
             if region in self.cache.keys():
-                nplist += self.cache.get(region)
+                arrays.append(select_years(self.cache.get(region), years))
             elif self.search_cache_file(region) is True:
+                if self.cache_backend == 'npy' and years is not None:
+                    # partial region is not kept in memory
+                    arrays.append(self.load_cache(region, years))
+                    continue
                 data = self.load_cache(region)
-                nplist += data
+                if self.cache_backend == 'pickle':
+                    data = as_array(data, self.d_type)
+                arrays.append(select_years(data, years))
                 self.cache[region] = data
             elif region in self.regions.keys():
                 data = self.parse_region_data(region)
                 self.cache[region] = data[1]
                 self.save_cache(region)
-                nplist += data[1]
+                arrays.append(select_years(data[1], years))
 
-        return self.col_list, nplist
+        # regions are structured arrays or dicts of memory mapped columns, both indexed by column name
+        if output == 'columns':
+            return self.col_list, self.categorical({name: concatenate([a[name] for a in arrays], self.d_type[name])
+                                                    for name in self.col_list})
+        # codes of text columns are decoded only once for all regions
+        data = self.decoded(concatenate([as_array(a, self.d_type) for a in arrays], self.d_type))
+        if output == 'list':
+            # compatibility with the former list of per row arrays
+            return self.col_list, list(data)
+        return self.col_list, data
 
 
 if __name__ == "__main__":
+    instrument.configure()
     downloader = DataDownloader()
     downloader.download_data()
     regions = ["VYS", "PHA", "PLK"]
-    region_data = downloader.get_list(regions)
+    region_data = downloader.get_list(regions, output='array')
     print("                   COLUMNS")
     print("----------------------------------------------")
     print(str(region_data[0]))
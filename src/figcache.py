@@ -0,0 +1,122 @@
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import matplotlib
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = Path(__file__).parent.parent.resolve() / ".figcache"
+MAX_BYTES = 256 * 2 ** 20
+
+
+def update_digest(h, value):
+    '''Feeds value to the hash object, frames are hashed by their columns, dtypes and values.'''
+    if isinstance(value, pd.DataFrame):
+        h.update(repr([(str(name), str(dtype)) for name, dtype in value.dtypes.items()]).encode())
+        update_digest(h, value.index)
+        for name in value.columns:
+            update_digest(h, value[name])
+    elif isinstance(value, (pd.Series, pd.Index)):
+        if getattr(value.dtype, "name", None) == "geometry":
+            # shapely geometries have no stable hash, their WKB is hashed instead
+            h.update(b"".join(geometry.wkb if geometry is not None else b"" for geometry in value))
+        else:
+            h.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(value.dtype.str.encode() + repr(value.shape).encode())
+        h.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value.tolist()).encode())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=repr):
+            h.update(repr(key).encode())
+            update_digest(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(b"%d" % len(value))
+        for item in value:
+            update_digest(h, item)
+    else:
+        h.update(repr(value).encode())
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(filename) -> str:
+    '''Hash of the source file drawing the figure together with the matplotlib version.'''
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read() + matplotlib.__version__.encode()).hexdigest()
+
+
+class FigureCache:
+    '''Rendered figures stored under a hash of their input data, parameters and code version.
+
+    The cache is bounded by the total size of stored files, the least recently used
+    figures are evicted first.'''
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES, enabled=True):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    def key(self, function, *data, **params) -> str:
+        '''Cache key of the figure drawn by function from the (already aggregated) data.'''
+        h = hashlib.sha256()
+        h.update(function.__module__.encode() + b"." + function.__qualname__.encode())
+        # instrumented plot functions are wrapped, the version is taken from the module of the plot itself
+        h.update(code_version(inspect.getsourcefile(inspect.unwrap(function))).encode())
+        update_digest(h, data)
+        update_digest(h, params)
+        return h.hexdigest()
+
+    def path(self, key, fig_location) -> Path:
+        '''Cached file of the key, the suffix follows the requested output format.'''
+        return self.directory / (key + Path(fig_location).suffix)
+
+    def fetch(self, key, fig_location, show_figure=False) -> bool:
+        '''Copies the cached figure to fig_location, returns False when it has to be rendered.'''
+        if not self.enabled or not fig_location or show_figure:
+            return False
+        path = self.path(key, fig_location)
+        try:
+            shutil.copyfile(path, fig_location)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        print(f"Using cached file... {fig_location}")
+        return True
+
+    def store(self, key, fig_location):
+        '''Stores the rendered figure and evicts old ones over the size limit.'''
+        if not self.enabled or not fig_location:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+        os.close(fd)
+        shutil.copyfile(fig_location, tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.path(key, fig_location))
+        self.evict()
+
+    def evict(self):
+        '''Removes least recently used figures until the cache fits into max_bytes.'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+FIGURES = FigureCache()
@@ -4,134 +4,189 @@
 import pandas as pd
 import geopandas
 import matplotlib.pyplot as plt
-import contextily as ctx
-import sklearn.cluster
 import numpy as np
 from pathlib import Path
+from cluster import N_CLUSTERS, SEED, fit_clusters, fit_weighted
+from coords import SJTSK, clean_coordinates, load_coordinates, print_report, reproject
+from dataset import load_dataset
+from figcache import FIGURES
+import instrument
+from instrument import TRACER, input_rows, output_rows
+from matplotlib.colors import LogNorm
+from spatial import SpatialIndex, add_cells
+from tiles import TileSource, add_basemap, open_store
 
+# stlpce potrebne pre grafy plot_geo a plot_cluster
+COLUMNS = ["p1", "p5a", "d", "e", "region"]
 
+# podkladova mapa z lokalneho uloziska dlazdic (naplni ho tiles.py), grafy nepotrebuju pristup na siet;
+# kluc obrazkov obsahuje odtlacok uloziska, po naplneni sa obrazky s prazdnou mapou nakreslia znova
+TILES = TileSource(open_store(Path(__file__).parent.parent.resolve() / "tiles"))
 
-def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
 
-    """Konvertovani dataframe do geopandas.GeoDataFrame se spravnym kodovani"""
-    df = df[df["d"].notna()]
-    df = df[df["e"].notna()]
+@TRACER.instrument("make_geo", rows=input_rows)
+def make_geo(df: pd.DataFrame, crs: str = SJTSK) -> geopandas.GeoDataFrame:
+
+    """Konvertovani dataframe do geopandas.GeoDataFrame se spravnym kodovani,
+    souradnice se vycisti (coords.py) a pripadne jednou prevedou do crs"""
+    x, y, report = clean_coordinates(df["d"].to_numpy(), df["e"].to_numpy(), df["region"].to_numpy())
+    print_report(report)
+    if crs != SJTSK:
+        x, y = reproject(x, y, crs)
+    return geo_frame(df, x, y, crs)
+
+
+@TRACER.instrument("load_geo", rows=output_rows)
+def load_geo(filename, crs: str = SJTSK, regions: list = None, years: list = None) -> geopandas.GeoDataFrame:
+    """GeoDataFrame z datasetu, vycistene a prevedene souradnice se ctou z uloziste vedle datasetu,
+    nacitaju sa iba particie zvolenych regionov a rokov"""
+    df = load_dataset(filename, COLUMNS, regions=regions, years=years)
+    x, y, report = load_coordinates(filename, crs, regions, years)
+    print_report(report)
+    return geo_frame(df, x, y, crs)
+
+
+def geo_frame(df: pd.DataFrame, x: np.ndarray, y: np.ndarray, crs: str) -> geopandas.GeoDataFrame:
+    """GeoDataFrame z radku s platnymi souradnicemi"""
+    valid = np.isfinite(x) & np.isfinite(y)
     print("Creating main GeoDataFrame...")
     gdf = geopandas.GeoDataFrame(
-        df, geometry=geopandas.points_from_xy(df["d"], df["e"]), 
-        crs="EPSG:5514"
+        df[valid], geometry=geopandas.points_from_xy(x[valid], y[valid]), 
+        crs=crs
     )
     return gdf
 
 
+@TRACER.instrument("plot_geo", rows=input_rows)
 def plot_geo(gdf: geopandas.GeoDataFrame, fig_location: str = None, 
     show_figure: bool = False
 ):
-    """ Vykresleni grafu s dvemi podgrafy podle lokality nehody """
+    """ Vykresleni grafu s dvemi podgrafy podle lokality nehody,
+    gdf muze byt i SpatialIndex, potom se kresli bunky mrizky misto bodu """
     if fig_location or show_figure:
+        if isinstance(gdf, SpatialIndex):
+            crs = SJTSK
+            cells = [gdf.cells(region="PLK", p5a=1), gdf.cells(region="PLK", p5a=2)]
+            key = FIGURES.key(plot_geo, cells, size=gdf.size(), kind=gdf.kind, basemap=TILES.fingerprint())
+        else:
+            crs = gdf.crs.to_string()
+            plk = gdf.query('region == "PLK"')
+            key = FIGURES.key(plot_geo, plk[["p5a", "geometry"]], crs=crs, basemap=TILES.fingerprint())
+        if FIGURES.fetch(key, fig_location, show_figure):
+            return
         print("Plotting points graph...")
         fig, axes = plt.subplots(
             1, 2, figsize=(11.69, 8.27), sharex=True,
             sharey=True
         )
-        plk = gdf.query('region == "PLK"')
-        plk[plk["p5a"] == 1].plot(
-            ax=axes[0],
-            markersize=4,
-            label="Nehody v obci",
-            color="tab:red",
-        )
-        plk[plk["p5a"] == 2].plot(
-            ax=axes[1],
-            markersize=4,
-            label="Nehody v obci",
-            color="tab:green",
-        )
+        if isinstance(gdf, SpatialIndex):
+            add_cells(axes[0], cells[0], gdf.size(), gdf.kind, cmap="Reds", norm=LogNorm(), alpha=0.8)
+            add_cells(axes[1], cells[1], gdf.size(), gdf.kind, cmap="Greens", norm=LogNorm(), alpha=0.8)
+        else:
+            plk[plk["p5a"] == 1].plot(
+                ax=axes[0],
+                markersize=4,
+                label="Nehody v obci",
+                color="tab:red",
+            )
+            plk[plk["p5a"] == 2].plot(
+                ax=axes[1],
+                markersize=4,
+                label="Nehody v obci",
+                color="tab:green",
+            )
         print("Adding base map...")
-        ctx.add_basemap(
-            axes[0], crs=plk.crs.to_string(), 
-            source=ctx.providers.Stamen.TonerLite
-        )
-        ctx.add_basemap(
-            axes[1], crs=plk.crs.to_string(), 
-            source=ctx.providers.Stamen.TonerLite
-        )
+        # osi su zdielane, druhy podgraf pouzije uz dekodovanu mozaiku
+        add_basemap(axes[0], TILES, crs=crs)
+        add_basemap(axes[1], TILES, crs=crs)
         axes[0].axis("off")
         axes[0].set_title("Nehody v PLK kraji: v obci", size=15)
         axes[1].axis("off")
         axes[1].set_title("Nehody v PLK kraji: mimo obec", size=15)
 
-        plt.tight_layout()
+        fig.tight_layout()
         if fig_location is not None:
             print(f"Storing the file... {fig_location}")
-            plt.savefig(fig_location)
+            fig.savefig(fig_location)
+            FIGURES.store(key, fig_location)
         if show_figure:
             plt.show()
 
 
+@TRACER.instrument("plot_cluster", rows=input_rows)
 def plot_cluster(
     gdf: geopandas.GeoDataFrame, fig_location: str = None, 
-    show_figure: bool = False
+    show_figure: bool = False, region: str = "PLK",
+    n_clusters: int = N_CLUSTERS, seed: int = SEED
 ):
-    """Vykresleni grafu s lokalitou nehod v kraji shlukovanych do clusteru"""
+    """Vykresleni grafu s lokalitou nehod v kraji shlukovanych do clusteru,
+    gdf muze byt i SpatialIndex, shlukuji se potom bunky vazene poctem nehod"""
     if fig_location or show_figure:
-        plk = gdf.query('region == "PLK"')
-        # ------------------------
-        coords_points = np.dstack([plk.geometry.x, plk.geometry.y]).reshape(-1, 2)
-        db = sklearn.cluster.MiniBatchKMeans(n_clusters=17).fit(coords_points)
-        db2 = plk.copy()
-        db2["cluster"] = db.labels_
-        # spojeni dohromad0 (funkce dissolve - geograficky ekvivalent groupby)
-        # KOD agregujeme jako pocet (a přejmenujeme na cnt) a plochu sumujeme
-        db2 = db2.dissolve(by="cluster", aggfunc={"p1": "count"}).rename(
-            columns=dict(p1="cnt")
-        )
-        
-        print("Creating clustered GeoDataFrame...")
-        coords = geopandas.GeoDataFrame(
-            geometry=geopandas.points_from_xy(
-                db.cluster_centers_[:, 0], db.cluster_centers_[:, 1]
+        if isinstance(gdf, SpatialIndex):
+            crs = SJTSK
+            cells = gdf.cells(region=region)
+            key = FIGURES.key(plot_cluster, cells, size=gdf.size(), kind=gdf.kind, region=region,
+                              n_clusters=n_clusters, seed=seed, basemap=TILES.fingerprint())
+        else:
+            crs = gdf.crs.to_string()
+            plk = gdf[gdf["region"] == region]
+            key = FIGURES.key(plot_cluster, plk[["geometry"]], crs=crs, region=region, n_clusters=n_clusters,
+                              seed=seed, basemap=TILES.fingerprint())
+        if FIGURES.fetch(key, fig_location, show_figure):
+            return
+        # pocet nehod v clusteroch je bincount nad labelmi, bez geometrickeho dissolve
+        if isinstance(gdf, SpatialIndex):
+            centers, counts = fit_weighted(
+                cells[["x", "y"]].to_numpy(), cells["count"].to_numpy(),
+                n_clusters, seed
+            )
+        else:
+            centers, counts = fit_clusters(
+                [(plk.geometry.x.to_numpy(), plk.geometry.y.to_numpy())],
+                n_clusters, seed
             )
-        )
 
-        print("Merging points to clusters...")
-        db3 = db2.merge(coords, left_on="cluster", right_index=True).set_geometry(
-            "geometry_y"
+        print("Creating clustered GeoDataFrame...")
+        db3 = geopandas.GeoDataFrame(
+            {"cnt": counts},
+            geometry=geopandas.points_from_xy(centers[:, 0], centers[:, 1]),
+            crs=crs
         )
 
         # Zobrazíme graf tak, že velikost bodu bude odpovídat
         print("Plotting cluster graph...")
-        plt.figure(figsize=(11.69, 8.27)) 
-        ax = plt.gca()
+        fig, ax = plt.subplots(figsize=(11.69, 8.27))
         ax.axis("off")
-        ax.set_title("Nehody v PLK kraji", size=15)
-        plk.plot(
-            ax=ax,
-            markersize=0.2,
-            color="tab:grey",
-        )
+        ax.set_title(f"Nehody v {region} kraji", size=15)
+        if isinstance(gdf, SpatialIndex):
+            add_cells(ax, cells, gdf.size(), gdf.kind, cmap="Greys", norm=LogNorm(), alpha=0.5)
+        else:
+            plk.plot(
+                ax=ax,
+                markersize=0.2,
+                color="tab:grey",
+            )
         db3.plot(
             ax=ax, markersize=db3["cnt"], column="cnt", legend=True,
             alpha=0.5
         )
         print("Adding base map...")
-        ctx.add_basemap(
-            ax, crs="EPSG:5514", source=ctx.providers.Stamen.TonerLite, 
-            alpha=0.6
-        )
+        add_basemap(ax, TILES, crs=crs, alpha=0.6)
 
-        plt.tight_layout()
+        fig.tight_layout()
         if fig_location is not None:
             print(f"Storing the file... {fig_location}")
-            plt.savefig(fig_location)
+            fig.savefig(fig_location)
+            FIGURES.store(key, fig_location)
         if show_figure:
             plt.show()
 
 
 if __name__ == "__main__":
     # vychodze nastavenie vystupu je do suborov graphs/geo1.png|geo2.png 
+    instrument.configure()
     main_folder = Path(__file__).parent.parent.resolve()
     print("Loading file data...")
-    gdf = make_geo(pd.read_pickle("accidents.pkl.gz"))
+    gdf = load_geo(main_folder / "accidents.pkl.gz")
     plot_geo(gdf, main_folder / "graphs/geo1.png", False)
     plot_cluster(gdf, main_folder / "graphs/geo2.png", False)
\ No newline at end of file
@@ -3,45 +3,65 @@ from matplotlib import pyplot as plt
 import math
 import re
 from download import DataDownloader
+import instrument
+from instrument import TRACER, input_rows
 from datetime import datetime
 import argparse as ap
 import os
 import errno
 
+# regions in the order of bars in plot_stat
+REGIONS = {'PHA': 1, 'STC': 2, 'JHC': 3, 'PLK': 4, 'ULK': 5, 'HKK': 6, 'JHM': 7, 'MSK': 8,
+           'OLK': 9, 'ZLK': 10, 'VYS': 11, 'PAK': 12, 'LBK': 13, 'KVK': 14}
 
+
+@TRACER.instrument("get_accident_stats", rows=input_rows)
 def get_accident_stats(data_source):
-    """parses the np.ndarray and coverts it to dictionary of statistics"""
+    """counts accidents of every region by year, rows may come in any order,
+    data is a structured np.ndarray, dict of columns or list of rows"""
     content = data_source[1]
-    current_date = str(np.datetime64(content[0]['f5']).astype('datetime64[Y]'))
-    current_region = str(content[0]['f66'])
-    region_stats = {current_date: 0}
+    if isinstance(content, list):
+        content = np.array(content).reshape(-1)
+    region_column = content['f66']
+    names = None
+    if hasattr(region_column, 'categories'):
+        # dictionary encoded regions, only names of the found codes get decoded
+        names, region_column = np.asarray(region_column.categories), region_column.codes
+    region_column = np.asarray(region_column)
+    if len(region_column) == 0:
+        return {}
+    # data comes region by region, unique regions are searched only among runs of equal values
+    starts = np.concatenate(([0], np.flatnonzero(region_column[1:] != region_column[:-1]) + 1))
+    regions, first, run_codes = np.unique(region_column[starts], return_index=True, return_inverse=True)
+    region_codes = np.repeat(run_codes.reshape(-1), np.diff(np.append(starts, len(region_column))))
+    first = starts[first]
+    years = np.asarray(content['f5']).astype('datetime64[Y]').astype(int) + 1970
+    year_values, year_codes = np.unique(years, return_inverse=True)
+    # one bincount over (region, year) integer keys
+    counts = np.bincount(region_codes * len(year_values) + year_codes.reshape(-1),
+                         minlength=len(regions) * len(year_values)).reshape(len(regions), len(year_values))
     stats = {}
-    for i in range(len(content)):
-        date = str(np.datetime64(content[i]['f5']).astype('datetime64[Y]'))
-        region = str(content[i]['f66'])
-        if (current_region != region):
-            stats[current_region] = region_stats
-            region_stats = {current_date: 0}
-            current_region = region
-        if (current_date == date):
-            region_stats[date] += 1
-        else:
-            region_stats[date] = 1
-            current_date = date
-    stats[current_region] = region_stats
+    # regions keep the order of their first occurrence in the data
+    for r in np.argsort(first):
+        stats[str(regions[r] if names is None else names[regions[r]])] = {str(year): int(count) for year, count in zip(year_values, counts[r]) if count}
     return stats
 
 
+def add_accident_stats(region_stats, new_stats):
+    """adds counts of get_accident_stats of new accidents (rows appended by an incremental refresh)
+    to already computed stats, nothing is recounted"""
+    merged = {region: dict(occurances) for region, occurances in region_stats.items()}
+    for region, occurances in new_stats.items():
+        counts = merged.setdefault(region, {})
+        for year, count in occurances.items():
+            counts[year] = counts.get(year, 0) + count
+    return merged
+
+
 def yearly_stats_by_regions(region_stats):
-    """processes occurances of a crash by a year in given regions"""
-    stats = {}
-    for region in region_stats.keys():
-        for year, occurance in sorted(region_stats[region].items()):
-            if year not in stats.keys():
-                stats[year] = [occurance]
-            else:
-                stats[year].append(occurance)
-    return stats
+    """processes occurances of a crash by a year in given regions, years missing in a region count as 0"""
+    years = sorted({year for occurances in region_stats.values() for year in occurances.keys()})
+    return {year: [region_stats[region].get(year, 0) for region in region_stats.keys()] for year in years}
 
 
 def label_bars(rects, ax, indexes):
@@ -59,10 +79,10 @@ def label_bars(rects, ax, indexes):
                     ha='center', va='bottom')
 
 
+@TRACER.instrument("plot_stat", rows=input_rows)
 def plot_stat(data_source, fig_location=None, show_figure=False):
     """labels bars in graph with order of accident occurances"""
-    regions = {'PHA': 1, 'STC': 2, 'JHC': 3, 'PLK': 4, 'ULK': 5, 'HKK': 6, 'JHM': 7, 'MSK': 8,
-               'OLK': 9, 'ZLK': 10, 'VYS': 11, 'PAK': 12, 'LBK': 13, 'KVK': 14}
+    regions = REGIONS
 
     # number of accidents by year in given region
     region_stats = get_accident_stats(data_source)
@@ -92,14 +112,14 @@ def plot_stat(data_source, fig_location=None, show_figure=False):
         axs[i].set_xticks(x)
         axs[i].set_xticklabels(x_labels, rotation='horizontal', fontsize=12)
 
-    plt.suptitle(
+    fig.suptitle(
         "Počet nehôd na území Českej Republiky v jednotlivých rokoch", fontsize=14)
-    plt.subplots_adjust(left=0.05, bottom=0.05, right=0.95,
+    fig.subplots_adjust(left=0.05, bottom=0.05, right=0.95,
                         top=0.95, wspace=0, hspace=0)
     if show_figure is True:
         plt.show()
     if fig_location is not None:
-        plt.savefig(fig_location)
+        fig.savefig(fig_location)
 
 
 def divide_file_dirs(path):
@@ -133,6 +153,8 @@ if __name__ == "__main__":
     parser = ap.ArgumentParser(description="get_stat.py")
     parser.add_argument("--fig_location", type=dir_path, action='store')
     parser.add_argument("--show_figure", default=False, action='store_true')
+    instrument.add_arguments(parser)
     arguments, leftovers = parser.parse_known_args()
-    data_source = DataDownloader().get_list(None)
+    instrument.configure(arguments)
+    data_source = DataDownloader().get_list(None, output='columns')
     plot_stat(data_source, arguments.fig_location, arguments.show_figure)
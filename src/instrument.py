@@ -0,0 +1,303 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import argparse as ap
+import atexit
+import cProfile
+import functools
+import json
+import os
+import platform
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# call sites of allocations shown by the tracemalloc mode and functions shown by the cProfile mode
+TOP = 15
+
+
+def rss() -> int:
+    """Current resident set size of the process in bytes"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes since the start or the last reset_peak_rss"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident set size to the current one (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def count_rows(data):
+    """Number of rows of a frame, array, dict of columns or (columns, data) tuple, None if unknown"""
+    if isinstance(data, tuple) and len(data) == 2 and isinstance(data[0], list):
+        data = data[1]
+    if isinstance(data, dict):
+        data = next(iter(data.values()), ())
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+def input_rows(result, data, *args, **kwargs):
+    """Rows of the first argument of the instrumented function"""
+    return count_rows(data)
+
+
+def output_rows(result, *args, **kwargs):
+    """Rows of the result of the instrumented function"""
+    return count_rows(result)
+
+
+class NoSpan:
+    """Span used while the tracer is disabled, it records nothing"""
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Span:
+    """Timed section of the pipeline with its row count and memory use.
+
+    The peak is measured by resetting the peak counter on entry, peaks of the section before
+    nested spans are kept in child_peak, so every span reports the peak of its whole duration."""
+
+    def __init__(self, tracer, name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.rows = None
+        self.child_peak = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, self.tracer.peak())
+        self.tracer.reset_peak()
+        self.memory = self.tracer.memory()
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.time_ns()
+        self.counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.counter
+        stack = self.tracer.stack()
+        stack.pop()
+        peak = max(self.tracer.peak(), self.child_peak)
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        record = {"name": self.name, "start": self.start / 1000, "seconds": duration, "pid": os.getpid(),
+                  "tid": threading.get_ident(), "depth": self.depth, "rows": self.rows,
+                  "rows_per_sec": self.rows / duration if self.rows and duration > 0 else None,
+                  "memory_mb": (self.tracer.memory() - self.memory) / 2 ** 20,
+                  "peak_mb": max(0, peak - self.memory) / 2 ** 20, "memory": self.tracer.memory_kind()}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        if self.attrs:
+            record["attrs"] = self.attrs
+        self.tracer.record(record)
+        return False
+
+
+class Tracer:
+    """Collector of spans, disabled until enable() so instrumented functions cost only one test"""
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def stack(self) -> list:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name: str, **attrs):
+        """Context manager of one span, rows are set on the returned span"""
+        return Span(self, name, attrs) if self.enabled else NO_SPAN
+
+    def instrument(self, name: str = None, rows=None, attrs=None):
+        """Decorator wrapping every call of the function in a span, rows(result, *args, **kwargs)
+        gives the number of processed rows and attrs(*args, **kwargs) attributes of the span"""
+        def decorator(function):
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(span_name, **(attrs(*args, **kwargs) if attrs else {})) as span:
+                    result = function(*args, **kwargs)
+                    if rows is not None:
+                        span.rows = rows(result, *args, **kwargs)
+                return result
+            return wrapper
+        return decorator
+
+    def memory_kind(self) -> str:
+        return "tracemalloc" if tracemalloc.is_tracing() else "rss"
+
+    def memory(self) -> int:
+        return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else rss()
+
+    def peak(self) -> int:
+        return tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else peak_rss()
+
+    def reset_peak(self):
+        if tracemalloc.is_tracing():
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        else:
+            reset_peak_rss()
+
+    def record(self, record: dict):
+        with self.lock:
+            self.spans.append(record)
+
+    def drain(self) -> list:
+        """Spans recorded by this process, the tracer is emptied (used by worker processes to send their
+        spans to the parent, spans inherited by a forked worker are dropped)"""
+        with self.lock:
+            spans, self.spans = self.spans, []
+        return [span for span in spans if span["pid"] == os.getpid()]
+
+    def merge(self, spans: list):
+        with self.lock:
+            self.spans.extend(spans)
+
+    def summary(self) -> list:
+        """Spans aggregated by name in the order of their first occurrence"""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span["name"], {"name": span["name"], "calls": 0, "seconds": 0.0, "rows": 0,
+                                                     "peak_mb": 0.0})
+            total["calls"] += 1
+            total["seconds"] += span["seconds"]
+            total["rows"] += span["rows"] or 0
+            total["peak_mb"] = max(total["peak_mb"], span["peak_mb"])
+        for total in totals.values():
+            total["rows_per_sec"] = total["rows"] / total["seconds"] if total["rows"] and total["seconds"] else None
+        return list(totals.values())
+
+    def print_summary(self, file=sys.stderr):
+        print("{:<32} {:>6} {:>10} {:>11} {:>12} {:>10}".format("span", "calls", "seconds", "rows", "rows/s",
+                                                              "peak MB"), file=file)
+        for total in self.summary():
+            print("{:<32} {:>6} {:>10.3f} {:>11} {:>12} {:>10.1f}".format(
+                total["name"][:32], total["calls"], total["seconds"], total["rows"] or "",
+                "{:.0f}".format(total["rows_per_sec"]) if total["rows_per_sec"] else "", total["peak_mb"]), file=file)
+
+    def to_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"spans": self.spans, "summary": self.summary()}, f, indent=1)
+
+    def to_chrome(self, filename):
+        """Spans as complete events of the Chrome trace format (chrome://tracing, Perfetto)"""
+        events = []
+        for span in self.spans:
+            args = {key: span[key] for key in ("rows", "rows_per_sec", "memory_mb", "peak_mb", "memory", "error")
+                    if span.get(key) is not None}
+            args.update(span.get("attrs", {}))
+            events.append({"name": span["name"], "cat": "pipeline", "ph": "X", "ts": span["start"],
+                           "dur": span["seconds"] * 1e6, "pid": span["pid"], "tid": span["tid"], "args": args})
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
+
+
+def add_arguments(parser: ap.ArgumentParser) -> ap.ArgumentParser:
+    """Instrumentation flags shared by the scripts"""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--trace", metavar="FILE", default=None,
+                       help="record spans and write them to FILE (json, or Chrome trace with --trace-format chrome)")
+    group.add_argument("--trace-format", choices=["json", "chrome"], default="json")
+    group.add_argument("--profile", metavar="FILE", default=None, help="run under cProfile and dump stats to FILE")
+    group.add_argument("--tracemalloc", action="store_true",
+                       help="measure span memory with tracemalloc and print top allocation sites")
+    return parser
+
+
+def configure(arguments=None):
+    """Switches instrumentation on from parsed arguments of add_arguments, scripts without an argument
+    parser let it parse the flags from sys.argv. Results are written when the script exits."""
+    if arguments is None:
+        arguments = add_arguments(ap.ArgumentParser(add_help=False)).parse_known_args()[0]
+    if not (arguments.trace or arguments.profile or arguments.tracemalloc):
+        return arguments
+    TRACER.enable()
+    if arguments.tracemalloc:
+        tracemalloc.start()
+    profiler = None
+    if arguments.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(finish, arguments, profiler)
+    return arguments
+
+
+def finish(arguments, profiler: cProfile.Profile = None):
+    """Writes and prints results of the instrumentation modes switched on by configure"""
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(arguments.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(TOP)
+    if tracemalloc.is_tracing():
+        print("Top allocation sites:", file=sys.stderr)
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:TOP]:
+            print(statistic, file=sys.stderr)
+        tracemalloc.stop()
+    TRACER.print_summary()
+    if arguments.trace:
+        Path(arguments.trace).parent.mkdir(parents=True, exist_ok=True)
+        if arguments.trace_format == "chrome":
+            TRACER.to_chrome(arguments.trace)
+        else:
+            TRACER.to_json(arguments.trace)
+        print("Trace written to {}".format(arguments.trace), file=sys.stderr)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import matplotlib
+matplotlib.use("Agg")
+
+import argparse as ap
+import multiprocessing
+import numpy as np
+import pandas as pd
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from matplotlib import pyplot as plt
+import analysis
+import doc
+import geo
+import get_stat
+from dataset import load_dataset
+from figcache import FIGURES
+import instrument
+from instrument import TRACER
+
+# vstupy grafov nacitane raz na proces, workery ich zdielaju cez fork (copy-on-write);
+# zdroj -> (data, None) alebo (None, traceback chyby nacitania)
+INPUTS = {}
+
+
+def load_cube(dataset):
+    """Agregacna kocka pre grafy z analysis.py"""
+    return analysis.get_cube(dataset)
+
+
+def load_geo(dataset):
+    """GeoDataFrame pre grafy z geo.py"""
+    return geo.load_geo(dataset)
+
+
+def load_doc(dataset):
+    """Tabulky pre graf z doc.py"""
+    return doc.stream_data(dataset)
+
+
+def load_stat(dataset):
+    """Stlpce kraja a datumu z datasetu v tvare DataDownloader.get_list(output='columns') pre graf
+    z get_stat.py, kraje su v poradi stlpcov grafu"""
+    df = load_dataset(dataset, ["region", "p2a"])
+    codes = pd.Categorical(df["region"].astype(str), categories=list(get_stat.REGIONS.keys())).codes
+    rows = np.argsort(np.where(codes < 0, len(get_stat.REGIONS), codes), kind="stable")
+    return ["f66", "f5"], {"f66": df["region"].astype(str).to_numpy()[rows],
+                           "f5": pd.to_datetime(df["p2a"]).to_numpy()[rows]}
+
+
+def plot_doc(data, fig_location: str = None):
+    """doc.plot_data s tabulkami v jednom argumente"""
+    doc.plot_data(*data, fig_location=fig_location)
+
+
+LOADERS = {"cube": load_cube, "geo": load_geo, "doc": load_doc, "stat": load_stat}
+
+# subor grafu -> (vstup, funkcia vykreslenia)
+JOBS = {
+    "01_nasledky.png": ("cube", analysis.plot_conseq),
+    "02_priciny.png": ("cube", analysis.plot_damage),
+    "03_stav.png": ("cube", analysis.plot_surface),
+    "geo1.png": ("geo", geo.plot_geo),
+    "geo2.png": ("geo", geo.plot_cluster),
+    "fig.png": ("doc", plot_doc),
+    "stat.png": ("stat", get_stat.plot_stat),
+}
+
+
+def load_input(dataset, source: str):
+    """Vstup grafov nacitany raz na proces, chyba nacitania sa zapamata a hlasi pri kazdom grafe,
+    ktory vstup potrebuje, ostatne grafy sa vykreslia"""
+    if source not in INPUTS:
+        try:
+            INPUTS[source] = LOADERS[source](dataset), None
+        except Exception:
+            INPUTS[source] = None, traceback.format_exc()
+    return INPUTS[source]
+
+
+def render(dataset, name: str, fig_location: str, cache: bool = True):
+    """Vykreslenie jedneho grafu vo worker procese, vracia (nazov, cas, chyba, spany workera)"""
+    source, function = JOBS[name]
+    FIGURES.enabled = cache
+    start = time.perf_counter()
+    try:
+        data, error = load_input(dataset, source)
+        if error is not None:
+            return name, None, "loading of input {} failed\n{}".format(source, error), TRACER.drain()
+        function(data, fig_location=fig_location)
+    except Exception:
+        return name, None, traceback.format_exc(), TRACER.drain()
+    finally:
+        plt.close("all")
+    return name, time.perf_counter() - start, None, TRACER.drain()
+
+
+def render_all(dataset, output, names: list = None, workers: int = None, cache: bool = True) -> list:
+    """Vykreslenie grafov v pooli procesov, kazdy graf do vlastneho suboru vo vystupnom adresari"""
+    names = list(JOBS.keys()) if names is None else names
+    sources = sorted({JOBS[name][0] for name in names})
+    Path(output).mkdir(parents=True, exist_ok=True)
+    if "fork" in multiprocessing.get_all_start_methods():
+        # data su nacitane iba raz, workery ich zdedia aj s chybami nacitania
+        for source in sources:
+            load_input(dataset, source)
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        # kazdy worker nacita vstup az pri prvom grafe, ktory ho potrebuje
+        pool = ProcessPoolExecutor(workers)
+    with pool:
+        jobs = [pool.submit(render, dataset, name, str(Path(output) / name), cache) for name in names]
+        results = []
+        for job in jobs:
+            name, duration, error, spans = job.result()
+            TRACER.merge(spans)
+            results.append((name, duration, error))
+    for name, duration, error in results:
+        if error is None:
+            print("{}: {:.2f} s".format(name, duration))
+        else:
+            print("{}: failed\n{}".format(name, error))
+    return results
+
+
+if __name__ == "__main__":
+    main_folder = Path(__file__).parent.parent.resolve()
+    parser = ap.ArgumentParser(description="render.py")
+    parser.add_argument("--dataset", default=main_folder / "accidents.pkl.gz")
+    parser.add_argument("--output", default=main_folder / "graphs")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--jobs", nargs="+", choices=list(JOBS.keys()), default=None)
+    parser.add_argument("--no-cache", action="store_true", help="vykreslit aj grafy s nezmenenymi datami")
+    instrument.add_arguments(parser)
+    arguments = parser.parse_args()
+    instrument.configure(arguments)
+    results = render_all(arguments.dataset, arguments.output, arguments.jobs, arguments.workers,
+                         not arguments.no_cache)
+    exit(1 if any(error is not None for _, _, error in results) else 0)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import argparse as ap
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from matplotlib.collections import PolyCollection
+from colstore import write_columns, read_columns, read_manifest, has_columns
+from coords import load_coordinates
+from dataset import load_dataset
+
+# stlpce potrebne pre index: region, v obci/mimo obec a nasledky, vycistene suradnice S-JTSK su z coords.py
+COLUMNS = ["region", "p5a", "p13a", "p13b", "p13c"]
+# velkosti buniek v metroch, od najjemnejsej
+SIZES = (500, 2000, 8000)
+SEVERITY = ["bez zraneni", "lehke zranenie", "tazke zranenie", "usmrtenie"]
+# index bunky (i, j) sa zbali do int64 ako (i + OFFSET) * SHIFT + (j + OFFSET)
+OFFSET = 2 ** 30
+SHIFT = 2 ** 31
+
+
+def severity(killed, severe, light) -> np.ndarray:
+    """Najtazsi nasledok nehody: 0 bez zraneni, 1 lahke, 2 tazke zranenie, 3 usmrtenie"""
+    result = np.zeros(len(killed), dtype=np.int8)
+    result[np.asarray(light) > 0] = 1
+    result[np.asarray(severe) > 0] = 2
+    result[np.asarray(killed) > 0] = 3
+    return result
+
+
+def square_cells(x: np.ndarray, y: np.ndarray, size: float):
+    """Indexy stvorcovych buniek"""
+    return np.floor(x / size).astype(np.int64), np.floor(y / size).astype(np.int64)
+
+
+def square_centers(i: np.ndarray, j: np.ndarray, size: float):
+    return (i + 0.5) * size, (j + 0.5) * size
+
+
+def hex_cells(x: np.ndarray, y: np.ndarray, size: float):
+    """Axialne suradnice hexagonov so spicou hore, size je vzdialenost stredov susednych buniek"""
+    radius = size / np.sqrt(3)
+    q = (np.sqrt(3) / 3 * x - y / 3) / radius
+    r = (2 / 3 * y) / radius
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    # zaokruhlenie kubickych suradnic, opravi sa zlozka s najvacsou chybou
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq[fix_q] = -rr[fix_q] - rs[fix_q]
+    rr[fix_r] = -rq[fix_r] - rs[fix_r]
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def hex_centers(q: np.ndarray, r: np.ndarray, size: float):
+    radius = size / np.sqrt(3)
+    return radius * np.sqrt(3) * (q + r / 2), radius * 1.5 * r
+
+
+GRIDS = {"square": (square_cells, square_centers), "hex": (hex_cells, hex_centers)}
+
+
+class SpatialIndex:
+    """Pocty nehod v bunkach stvorcovej alebo hexagonalnej mriezky vo viacerych rozliseniach
+
+    Kazde rozlisenie je riedka tabulka (cell, region, p5a, severity, count) zoradena podla bunky,
+    bunka je zakodovana ako (i + OFFSET) * SHIFT + (j + OFFSET)."""
+
+    def __init__(self, levels: dict, regions: list, kind: str = "square"):
+        self.levels = levels
+        self.regions = list(regions)
+        self.kind = kind
+
+    @classmethod
+    def build(cls, x, y, region, p5a, severity, sizes=SIZES, kind: str = "square"):
+        """Index z poli suradnic a atributov nehod, nehody bez suradnic sa preskocia"""
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        valid = np.isfinite(x) & np.isfinite(y)
+        regions, region_codes = np.unique(np.asarray(region).astype(str)[valid], return_inverse=True)
+        p5a = np.asarray(p5a)[valid]
+        p5a = np.where((p5a == 1) | (p5a == 2), p5a, 0).astype(np.int64)
+        severity = np.asarray(severity)[valid].astype(np.int64)
+        x, y = x[valid], y[valid]
+        # region, p5a a nasledky v jednom kode pre bincount
+        attributes = (region_codes.reshape(-1) * 3 + p5a) * len(SEVERITY) + severity
+        width = len(regions) * 3 * len(SEVERITY)
+        levels = {}
+        for size in sizes:
+            i, j = GRIDS[kind][0](x, y, size)
+            cells, cell_codes = np.unique((i + OFFSET) * SHIFT + (j + OFFSET), return_inverse=True)
+            keys, counts = np.unique(cell_codes.reshape(-1) * width + attributes, return_counts=True)
+            cell, rest = np.divmod(keys, width)
+            rest, sev = np.divmod(rest, len(SEVERITY))
+            reg, p = np.divmod(rest, 3)
+            levels[size] = {"cell": cells[cell], "region": reg.astype(np.int16), "p5a": p.astype(np.int8),
+                            "severity": sev.astype(np.int8), "count": counts.astype(np.int32)}
+        return cls(levels, regions.tolist(), kind)
+
+    def save(self, directory):
+        for size, table in self.levels.items():
+            write_columns(Path(directory) / "{}-{}".format(self.kind, size), table,
+                          kind=self.kind, size=size, regions=self.regions)
+
+    @classmethod
+    def load(cls, directory, kind: str = "square"):
+        levels, regions = {}, []
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if entry.name.startswith(kind + "-") and has_columns(entry.path):
+                manifest = read_manifest(entry.path)
+                levels[manifest["size"]] = read_columns(entry.path)
+                regions = manifest["regions"]
+        return cls(dict(sorted(levels.items())), regions, kind)
+
+    def level(self, size=None) -> dict:
+        """Tabulka rozlisenia size, predvolene najjemnejsieho"""
+        return self.levels[self.size(size)]
+
+    def size(self, size=None):
+        """Velkost buniek rozlisenia, predvolene najjemnejsieho"""
+        return min(self.levels) if size is None else size
+
+    def cells(self, size=None, region=None, p5a=None, severity=None) -> pd.DataFrame:
+        """Pocty nehod po bunkach (stredy x, y a count) pre zvoleny region, p5a a minimalne nasledky"""
+        table = self.level(size)
+        mask = np.ones(len(table["cell"]), dtype=bool)
+        if region is not None:
+            mask &= table["region"] == (self.regions.index(region) if region in self.regions else -1)
+        if p5a is not None:
+            mask &= table["p5a"] == p5a
+        if severity is not None:
+            mask &= table["severity"] >= severity
+        cells, inverse = np.unique(np.asarray(table["cell"][mask]), return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=table["count"][mask], minlength=len(cells))
+        i, j = cells // SHIFT - OFFSET, cells % SHIFT - OFFSET
+        x, y = GRIDS[self.kind][1](i, j, self.size(size))
+        return pd.DataFrame({"x": x, "y": y, "count": counts.astype(np.int64)})
+
+    def bbox(self, xmin, ymin, xmax, ymax, size=None, **filters) -> pd.DataFrame:
+        """Bunky so stredom v obdlzniku"""
+        cells = self.cells(size, **filters)
+        inside = (cells["x"] >= xmin) & (cells["x"] <= xmax) & (cells["y"] >= ymin) & (cells["y"] <= ymax)
+        return cells[inside.to_numpy()].reset_index(drop=True)
+
+    def hotspots(self, n: int = 10, size=None, **filters) -> pd.DataFrame:
+        """n buniek s najvacsim poctom nehod"""
+        cells = self.cells(size, **filters)
+        top = np.argsort(-cells["count"].to_numpy(), kind="stable")[:n]
+        return cells.iloc[top].reset_index(drop=True)
+
+
+def add_cells(ax, cells: pd.DataFrame, size: float, kind: str = "square", **kwargs):
+    """Vykreslenie buniek ako polygonov zafarbenych podla poctu nehod (kwargs idu do PolyCollection)"""
+    if kind == "hex":
+        angles = np.radians(30 + 60 * np.arange(6))
+        corners = np.column_stack((np.cos(angles), np.sin(angles))) * size / np.sqrt(3)
+    else:
+        corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size / 2
+    centers = cells[["x", "y"]].to_numpy()
+    collection = PolyCollection(centers[:, None, :] + corners[None, :, :], array=cells["count"].to_numpy(),
+                                **kwargs)
+    ax.add_collection(collection)
+    ax.set_aspect("equal")
+    ax.autoscale_view()
+    return collection
+
+
+def index_path(filename) -> Path:
+    """Adresar indexu patriaci k suboru s datami"""
+    filename = Path(filename)
+    return filename.with_name(filename.name.split(".")[0] + ".grid")
+
+
+def load_index(filename, kind: str = "square", sizes=SIZES) -> SpatialIndex:
+    """Nacitanie indexu ulozeneho vedla datasetu, index sa prepocita ak je dataset novsi"""
+    directory = index_path(filename)
+    levels = [directory / "{}-{}".format(kind, size) for size in sizes]
+    if all(has_columns(level) and os.path.getmtime(level) >= os.path.getmtime(filename) for level in levels):
+        index = SpatialIndex.load(directory, kind)
+        index.levels = {size: index.levels[size] for size in sizes}
+        return index
+    print("Building spatial index...")
+    df = load_dataset(filename, COLUMNS)
+    x, y, _ = load_coordinates(filename)
+    index = SpatialIndex.build(x, y, df["region"], df["p5a"],
+                               severity(df["p13a"], df["p13b"], df["p13c"]), sizes, kind)
+    index.save(directory)
+    return index
+
+
+if __name__ == "__main__":
+    main_folder = Path(__file__).parent.parent.resolve()
+    parser = ap.ArgumentParser(description="spatial.py")
+    parser.add_argument("--dataset", default=main_folder / "accidents.pkl.gz")
+    parser.add_argument("--kind", choices=list(GRIDS.keys()), default="square")
+    parser.add_argument("--region", default=None)
+    parser.add_argument("--size", type=int, default=None)
+    parser.add_argument("--hotspots", type=int, default=10)
+    arguments = parser.parse_args()
+    index = load_index(arguments.dataset, arguments.kind)
+    print(index.hotspots(arguments.hotspots, arguments.size, region=arguments.region))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3.8
+# coding=utf-8
+
+import argparse as ap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import scipy.stats
+from dataset import DATE, REGION, load_dataset
+from spatial import severity
+
+# categorical factors tested against severity of the accident
+FACTORS = ["p5a", "p11", "p12", "p16", "p18", "p19", "p36", "p37"]
+TARGET = "severity"
+SEED = 0
+CONFIDENCE = 0.95
+# resamples drawn from one seed, blocks are the unit of work of the bootstrap pool
+BLOCK = 256
+
+
+def encode(values):
+    """Integer codes of the values and their sorted levels, missing values and empty strings get code -1"""
+    values = pd.Series(values)
+    if values.dtype == object:
+        values = values.replace("", np.nan)
+    codes, levels = pd.factorize(values, sort=True)
+    return codes.astype(np.int64), np.asarray(levels)
+
+
+def column_years(values) -> np.ndarray:
+    """Year of every date, distinct date strings are parsed only once"""
+    codes, dates = pd.factorize(pd.Series(values))
+    years = np.append(pd.to_datetime(pd.Series(dates), errors="coerce").dt.year.to_numpy(dtype=np.float64), np.nan)
+    return years[codes]
+
+
+def contingency(x_codes, y_codes, nx: int, ny: int, group_codes=None, ngroups: int = 1) -> np.ndarray:
+    """Contingency tables of shape (ngroups, nx, ny) counted with one bincount over the joint integer key,
+    rows with any negative code are skipped"""
+    x_codes = np.asarray(x_codes, dtype=np.int64)
+    y_codes = np.asarray(y_codes, dtype=np.int64)
+    group_codes = np.zeros(len(x_codes), dtype=np.int64) if group_codes is None else np.asarray(group_codes, np.int64)
+    valid = (x_codes >= 0) & (y_codes >= 0) & (group_codes >= 0)
+    keys = (group_codes[valid] * nx + x_codes[valid]) * ny + y_codes[valid]
+    return np.bincount(keys, minlength=ngroups * nx * ny).reshape(ngroups, nx, ny)
+
+
+def chi2_test(tables, correction: bool = True):
+    """Chi-square test of independence of a batch of (k, r, c) tables, returns chi2, p-values and degrees
+    of freedom. Empty rows and columns are ignored, otherwise the result equals scipy.stats.chi2_contingency
+    (including Yates' correction for one degree of freedom)."""
+    observed = np.asarray(tables, dtype=np.float64)
+    rows = observed.sum(axis=2)
+    columns = observed.sum(axis=1)
+    n = rows.sum(axis=1)
+    expected = rows[:, :, None] * columns[:, None, :] / np.where(n > 0, n, 1)[:, None, None]
+    dof = (np.count_nonzero(rows, axis=1) - 1).clip(0) * (np.count_nonzero(columns, axis=1) - 1).clip(0)
+    diff = observed - expected
+    if correction:
+        yates = (dof == 1)[:, None, None]
+        diff = np.where(yates, np.sign(diff) * np.maximum(np.abs(diff) - 0.5, 0), diff)
+    terms = np.divide(diff ** 2, expected, out=np.zeros_like(expected), where=expected > 0)
+    chi2 = np.where(dof > 0, terms.sum(axis=(1, 2)), 0.0)
+    p = np.where(dof > 0, scipy.stats.chi2.sf(chi2, np.maximum(dof, 1)), 1.0)
+    return chi2, p, dof
+
+
+def cramers_v(tables) -> np.ndarray:
+    """Cramer's V of a batch of (k, r, c) tables, NaN for tables with a single non-empty row or column"""
+    tables = np.asarray(tables, dtype=np.float64)
+    chi2, _, _ = chi2_test(tables, correction=False)
+    n = tables.sum(axis=(1, 2))
+    size = np.minimum(np.count_nonzero(tables.sum(axis=2), axis=1), np.count_nonzero(tables.sum(axis=1), axis=1)) - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(size > 0, np.sqrt(chi2 / (n * size)), np.nan)
+
+
+def pearson(tables, x_values, y_values) -> np.ndarray:
+    """Pearson correlation coefficient of a batch of (k, r, c) tables counting pairs of numeric values
+    x_values[i], y_values[j], equal to scipy.stats.pearsonr of the expanded rows"""
+    weights = np.asarray(tables, dtype=np.float64)
+    x = np.asarray(x_values, dtype=np.float64)[None, :, None]
+    y = np.asarray(y_values, dtype=np.float64)[None, None, :]
+    n = weights.sum(axis=(1, 2))[:, None, None]
+    dx = x - (weights * x).sum(axis=(1, 2))[:, None, None] / n
+    dy = y - (weights * y).sum(axis=(1, 2))[:, None, None] / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ((weights * dx * dy).sum(axis=(1, 2)) /
+                np.sqrt((weights * dx ** 2).sum(axis=(1, 2)) * (weights * dy ** 2).sum(axis=(1, 2))))
+
+
+def pearson_p(r, n) -> np.ndarray:
+    """Two-sided p-value of the correlation coefficient r of n pairs"""
+    r = np.clip(np.asarray(r, dtype=np.float64), -1, 1)
+    dof = np.asarray(n, dtype=np.float64) - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt(dof / (1 - r ** 2))
+    return np.where(dof > 0, 2 * scipy.stats.t.sf(np.abs(t), np.maximum(dof, 1)), np.nan)
+
+
+STATISTICS = {"cramer": cramers_v, "pearson": pearson}
+
+
+def resample_block(table: np.ndarray, statistic: str, resamples: int, seed, options: dict) -> np.ndarray:
+    """Statistic of resamples of the table, resampling rows with replacement equals drawing
+    the cell counts from a multinomial distribution, so the cost does not depend on the number of rows"""
+    rng = np.random.default_rng(seed)
+    n = int(table.sum())
+    samples = rng.multinomial(n, table.reshape(-1) / n, size=resamples).reshape(resamples, *table.shape)
+    return STATISTICS[statistic](samples, **options)
+
+
+def bootstrap(table, statistic: str = "cramer", n_resamples: int = 1000, confidence: float = CONFIDENCE,
+              seed: int = SEED, workers: int = None, **options):
+    """Percentile bootstrap confidence interval of the statistic of one (r, c) table, returns (estimate, low, high).
+
+    Resamples are split into blocks seeded from one SeedSequence and computed in a process pool,
+    the interval is the same for any number of workers."""
+    table = np.asarray(table, dtype=np.int64)
+    estimate = STATISTICS[statistic](table[None], **options)[0]
+    blocks = [min(BLOCK, n_resamples - start) for start in range(0, n_resamples, BLOCK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+    if workers == 1 or len(blocks) == 1:
+        values = [resample_block(table, statistic, size, block_seed, options) for size, block_seed in zip(blocks, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            values = list(pool.map(resample_block, [table] * len(blocks), [statistic] * len(blocks), blocks, seeds,
+                                   [options] * len(blocks)))
+    values = np.concatenate(values)
+    values = values[np.isfinite(values)]
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(values, [alpha, 1 - alpha]) if len(values) else (np.nan, np.nan)
+    return estimate, low, high
+
+
+def load_frame(filename, factors: list = FACTORS, by: list = (REGION, "year")) -> pd.DataFrame:
+    """Factors, grouping columns and severity of accidents from the dataset"""
+    by = list(by)
+    columns = set(factors) | {"p13a", "p13b", "p13c"} | ({DATE} if "year" in by else set()) | (set(by) - {"year"})
+    df = load_dataset(filename, sorted(columns))
+    df[TARGET] = severity(df["p13a"], df["p13b"], df["p13c"])
+    if "year" in by:
+        df["year"] = column_years(df[DATE])
+    return df
+
+
+def test_factors(df: pd.DataFrame, factors: list = FACTORS, target: str = TARGET, by: list = (REGION, "year"),
+                 correction: bool = True) -> pd.DataFrame:
+    """Chi-square tests of every factor against the target overall and within every group of every `by` column.
+
+    For every factor one contingency table of all (by..., factor, target) combinations is counted, tables
+    of single groups and the overall table are its marginal sums."""
+    by = list(by)
+    target_codes, target_levels = encode(df[target])
+    group_codes, group_levels = zip(*(encode(df[name]) for name in by)) if by else ((), ())
+    shape = [len(levels) for levels in group_levels]
+    # mixed radix code of the combination of groups
+    joint = np.zeros(len(df), dtype=np.int64)
+    for codes, size in zip(group_codes, shape):
+        joint = np.where((joint < 0) | (codes < 0), -1, joint * size + codes)
+    results = []
+    for factor in factors:
+        codes, levels = encode(df[factor])
+        tables = contingency(codes, target_codes, len(levels), len(target_levels), joint, int(np.prod(shape)))
+        tables = tables.reshape(*shape, len(levels), len(target_levels))
+        batches = [("", [""], tables.reshape(-1, len(levels), len(target_levels)).sum(axis=0)[None])]
+        for axis, name in enumerate(by):
+            other = tuple(i for i in range(len(by)) if i != axis)
+            batches.append((name, group_levels[axis], tables.sum(axis=other)))
+        for name, groups, batch in batches:
+            chi2, p, dof = chi2_test(batch, correction)
+            results.append(pd.DataFrame({"factor": factor, "by": name, "group": list(groups),
+                                         "n": batch.sum(axis=(1, 2)), "chi2": chi2, "dof": dof, "p": p,
+                                         "cramers_v": cramers_v(batch)}))
+    return pd.concat(results, ignore_index=True)
+
+
+def prepare_influence(df: pd.DataFrame) -> pd.DataFrame:
+    """Rows and columns of the notebook hypothesis: influence of the driver (p11) against number
+    of killed or severely injured persons, records without influence and with drugs are excluded"""
+    p11 = df["p11"]
+    valid = p11.notna() & (p11 > 0) & (p11 != 4) & (p11 != 5) & df["p13a"].notna() & df["p13b"].notna()
+    df = df[valid]
+    return pd.DataFrame({
+        "influence": df["p11"],
+        "hard casualties": df["p13a"] + df["p13b"],
+        "deaths": df["p13a"],
+        "casualties": df["p13b"],
+    })
+
+
+def test_influence(df: pd.DataFrame) -> dict:
+    """Pearson correlation of influence and hard casualties and chi-square test of a very drunk driver
+    (p11 >= 7) against an accident with hard casualties, computed from contingency tables"""
+    data = prepare_influence(df)
+    x_codes, x_levels = encode(data["influence"])
+    y_codes, y_levels = encode(data["hard casualties"])
+    values = contingency(x_codes, y_codes, len(x_levels), len(y_levels))
+    r = pearson(values, x_levels, y_levels)[0]
+    drunk = contingency(data["influence"].to_numpy() >= 7, data["hard casualties"].to_numpy() > 0, 2, 2)
+    chi2, p, dof = chi2_test(drunk)
+    return {"pearson": r, "pearson_p": pearson_p(r, len(data))[()], "chi2": chi2[0], "chi2_p": p[0],
+            "dof": dof[0], "values": values[0], "levels": (x_levels, y_levels), "table": drunk[0]}
+
+
+if __name__ == "__main__":
+    main_folder = Path(__file__).parent.parent.resolve()
+    parser = ap.ArgumentParser(description="stattest.py")
+    parser.add_argument("--dataset", default=main_folder / "accidents.pkl.gz")
+    parser.add_argument("--factors", nargs="+", default=FACTORS)
+    parser.add_argument("--by", nargs="*", default=[REGION, "year"])
+    parser.add_argument("--bootstrap", type=int, default=1000, help="number of resamples, 0 disables intervals")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=SEED)
+    arguments = parser.parse_args()
+    start = time.perf_counter()
+    df = load_frame(arguments.dataset, arguments.factors, arguments.by)
+
+    influence = test_influence(df)
+    print("Influence vs hard casualties: pearson r {:.5f} (p {:.3g}), chi2 {:.2f} (p {:.3g})".format(
+        influence["pearson"], influence["pearson_p"], influence["chi2"], influence["chi2_p"]))
+    if arguments.bootstrap:
+        _, low, high = bootstrap(influence["values"], "pearson", arguments.bootstrap, seed=arguments.seed,
+                                 workers=arguments.workers, x_values=influence["levels"][0],
+                                 y_values=influence["levels"][1])
+        print("  pearson r {:.0%} interval [{:.5f}, {:.5f}]".format(CONFIDENCE, low, high))
+
+    results = test_factors(df, arguments.factors, by=arguments.by)
+    if arguments.bootstrap:
+        overall = results[results["by"] == ""]
+        target_codes, target_levels = encode(df[TARGET])
+        intervals = {}
+        for factor in overall["factor"]:
+            codes, levels = encode(df[factor])
+            table = contingency(codes, target_codes, len(levels), len(target_levels))[0]
+            intervals[factor] = bootstrap(table, "cramer", arguments.bootstrap, seed=arguments.seed,
+                                          workers=arguments.workers)[1:]
+        results.loc[overall.index, "v_low"] = [intervals[factor][0] for factor in overall["factor"]]
+        results.loc[overall.index, "v_high"] = [intervals[factor][1] for factor in overall["factor"]]
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(results)
+    print("Tested in {:.2f} s".format(time.perf_counter() - start))
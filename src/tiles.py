@@ -0,0 +1,396 @@
+import argparse as ap
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+import time
+import warnings
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+import mercantile
+import numpy as np
+import requests
+from PIL import Image
+from pyproj import CRS, Transformer
+
+TILE_SIZE = 256
+WEB_MERCATOR = "EPSG:3857"
+MAX_LATITUDE = 85.0511
+MAX_BYTES = 512 * 2 ** 20
+MAX_TILES = 10000
+HEADERS = {"User-Agent": "accident-analysis tile prefetch"}
+
+
+class DirectoryTileStore:
+    '''Tiles stored as {z}/{x}/{y}.png files, bounded by total size with least recently used eviction.
+
+    max_bytes=None keeps every tile, which suits a pre-seeded store used offline.'''
+
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.key = str(self.root.resolve())
+        self._bytes = None
+
+    def path(self, z, x, y) -> Path:
+        return self.root / str(z) / str(x) / ("%d.png" % y)
+
+    def get(self, z, x, y):
+        '''Tile bytes or None, reading a tile marks it as recently used.'''
+        path = self.path(z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if self.max_bytes is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                # pre-seeded read-only store, tiles are served without recording their use
+                pass
+        return data
+
+    def put(self, z, x, y, data):
+        path = self.path(z, x, y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=path.parent)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        # size of the store is counted by walking the directory only on the first write and on eviction
+        if self._bytes is None:
+            self.evict()
+        else:
+            self._bytes += len(data)
+            if self.max_bytes is not None and self._bytes > self.max_bytes:
+                self.evict()
+
+    def zooms(self) -> list:
+        '''Zoom levels present in the store.'''
+        if not self.root.is_dir():
+            return []
+        return sorted(int(entry.name) for entry in os.scandir(self.root) if entry.is_dir() and entry.name.isdigit())
+
+    def fingerprint(self) -> str:
+        '''Hash of the stored tiles and their sizes, reading tiles does not change it.'''
+        h = hashlib.sha256()
+        if self.root.is_dir():
+            entries = []
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    if name.startswith("."):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        entries.append((os.path.relpath(path, self.root), os.path.getsize(path)))
+                    except FileNotFoundError:
+                        continue
+            h.update(repr(sorted(entries)).encode())
+        return h.hexdigest()
+
+    def evict(self):
+        '''Removes least recently used tiles until the store fits into max_bytes.'''
+        if self.max_bytes is None:
+            return
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+
+
+class MBTilesStore:
+    '''Tiles in a MBTiles (SQLite) file, access times are kept in a side table for least recently used eviction.
+
+    Rows use the TMS numbering of the MBTiles specification, the interface takes XYZ tiles like
+    DirectoryTileStore. The connection is opened lazily per process so the store survives fork.'''
+
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.key = str(self.path.resolve())
+        self._connection = None
+        self._pid = None
+        self.read_only = False
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30)
+            self._pid = os.getpid()
+            try:
+                self._connection.executescript(
+                    "CREATE TABLE IF NOT EXISTS metadata (name text, value text);"
+                    "CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer,"
+                    " tile_data blob);"
+                    "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);"
+                    "CREATE TABLE IF NOT EXISTS tile_access (zoom_level integer, tile_column integer,"
+                    " tile_row integer, accessed real, PRIMARY KEY (zoom_level, tile_column, tile_row));")
+            except sqlite3.OperationalError:
+                # pre-seeded file without write access is only read
+                self._connection.close()
+                self._connection = sqlite3.connect(self.path.resolve().as_uri() + "?mode=ro", uri=True, timeout=30)
+                self.read_only = True
+        return self._connection
+
+    def get(self, z, x, y):
+        row = (1 << z) - 1 - y
+        with self.connection as connection:
+            result = connection.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND "
+                                        "tile_row=?", (z, x, row)).fetchone()
+        if result is None:
+            return None
+        if self.max_bytes is not None and not self.read_only:
+            try:
+                with self.connection as connection:
+                    connection.execute("INSERT OR REPLACE INTO tile_access VALUES (?, ?, ?, ?)",
+                                       (z, x, row, time.time()))
+            except sqlite3.OperationalError:
+                # tiles are served without recording their use when the file cannot be written
+                pass
+        return bytes(result[0])
+
+    def put(self, z, x, y, data):
+        row = (1 << z) - 1 - y
+        with self.connection as connection:
+            connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (z, x, row, sqlite3.Binary(data)))
+            connection.execute("INSERT OR REPLACE INTO tile_access VALUES (?, ?, ?, ?)", (z, x, row, time.time()))
+        self.evict()
+
+    def zooms(self) -> list:
+        return [z for z, in self.connection.execute("SELECT DISTINCT zoom_level FROM tiles ORDER BY zoom_level")]
+
+    def fingerprint(self) -> str:
+        '''Hash of the stored tiles and their sizes, reading tiles does not change it.'''
+        h = hashlib.sha256()
+        for row in self.connection.execute("SELECT zoom_level, tile_column, tile_row, length(tile_data) FROM tiles "
+                                           "ORDER BY zoom_level, tile_column, tile_row"):
+            h.update(repr(row).encode())
+        return h.hexdigest()
+
+    def evict(self):
+        '''Removes least recently used tiles until the store fits into max_bytes, never read tiles go first.'''
+        if self.max_bytes is None:
+            return
+        with self.connection as connection:
+            total, = connection.execute("SELECT coalesce(sum(length(tile_data)), 0) FROM tiles").fetchone()
+            if total <= self.max_bytes:
+                return
+            rows = connection.execute(
+                "SELECT t.zoom_level, t.tile_column, t.tile_row, length(t.tile_data) FROM tiles t "
+                "LEFT JOIN tile_access a USING (zoom_level, tile_column, tile_row) "
+                "ORDER BY coalesce(a.accessed, 0)").fetchall()
+            remove = []
+            for z, x, row, size in rows:
+                if total <= self.max_bytes:
+                    break
+                remove.append((z, x, row))
+                total -= size
+            connection.executemany("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", remove)
+            connection.executemany("DELETE FROM tile_access WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                   remove)
+
+
+def open_store(path, max_bytes=MAX_BYTES):
+    '''MBTilesStore for .mbtiles files, DirectoryTileStore otherwise.'''
+    if str(path).endswith(".mbtiles"):
+        return MBTilesStore(path, max_bytes)
+    return DirectoryTileStore(path, max_bytes)
+
+
+class TileSource:
+    '''Tiles read from a local store, missing tiles are downloaded from url ("https://.../{z}/{x}/{y}.png")
+    and stored when it is set. Without url the source works fully offline and missing tiles stay empty.'''
+
+    def __init__(self, store, url: str = None, max_zoom: int = 19, timeout: int = 30, headers: dict = None):
+        self.store = store
+        self.url = url
+        self.max_zoom = max_zoom
+        self.timeout = timeout
+        self.headers = dict(HEADERS, **(headers or {}))
+        self.key = (store.key, url)
+        self.session = None
+
+    def fingerprint(self) -> str:
+        '''Key of the source together with a hash of the tiles stored so far, figures drawn over the basemap
+        are cached under it and get redrawn once the store is seeded.'''
+        return hashlib.sha256(repr((self.key, self.store.fingerprint())).encode()).hexdigest()
+
+    def tile(self, z, x, y):
+        '''PNG bytes of the tile or None when it is neither stored nor downloadable.'''
+        data = self.store.get(z, x, y)
+        if data is not None or self.url is None:
+            return data
+        if self.session is None:
+            self.session = requests.Session()
+        response = self.session.get(self.url.format(z=z, x=x, y=y), headers=self.headers, timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        self.store.put(z, x, y, response.content)
+        return response.content
+
+    def zoom(self, lonlat_bounds) -> int:
+        '''Zoom level for the bounds like contextily chooses it, limited to zooms of the store when offline.'''
+        w, s, e, n = lonlat_bounds
+        zoom = max(math.ceil(math.log2(360 * 2.0 / max(e - w, 1e-9))),
+                   math.ceil(math.log2(180 * 2.0 / max(n - s, 1e-9))))
+        zoom = min(zoom, self.max_zoom)
+        if self.url is None:
+            zooms = self.store.zooms()
+            lower = [z for z in zooms if z <= zoom]
+            if lower:
+                zoom = lower[-1]
+            elif zooms:
+                zoom = zooms[0]
+        return zoom
+
+    def prefetch(self, lonlat_bounds, zooms) -> dict:
+        '''Stores all tiles covering the bounds at given zooms, returns counts of stored and missing tiles.'''
+        w, s, e, n = clamp_bounds(lonlat_bounds)
+        tiles = [tile for zoom in zooms for tile in mercantile.tiles(w, s, e, n, zoom)]
+        if len(tiles) > MAX_TILES:
+            raise ValueError("prefetch of %d tiles exceeds the limit of %d" % (len(tiles), MAX_TILES))
+        counts = {"tiles": len(tiles), "missing": 0}
+        for tile in tiles:
+            if self.tile(tile.z, tile.x, tile.y) is None:
+                counts["missing"] += 1
+        return counts
+
+    def mosaic(self, lonlat_bounds, zoom):
+        '''Decoded tiles covering the bounds as one RGBA image, its extent (left, right, bottom, top)
+        in web mercator and the number of missing tiles, which stay transparent.'''
+        w, s, e, n = clamp_bounds(lonlat_bounds)
+        tiles = list(mercantile.tiles(w, s, e, n, zoom))
+        xs = [tile.x for tile in tiles]
+        ys = [tile.y for tile in tiles]
+        x0, y0 = min(xs), min(ys)
+        image = np.zeros(((max(ys) - y0 + 1) * TILE_SIZE, (max(xs) - x0 + 1) * TILE_SIZE, 4), dtype=np.uint8)
+        missing = 0
+        for tile in tiles:
+            data = self.tile(tile.z, tile.x, tile.y)
+            if data is None:
+                missing += 1
+                continue
+            row, column = (tile.y - y0) * TILE_SIZE, (tile.x - x0) * TILE_SIZE
+            decoded = np.asarray(Image.open(BytesIO(data)).convert("RGBA").resize((TILE_SIZE, TILE_SIZE)))
+            image[row:row + TILE_SIZE, column:column + TILE_SIZE] = decoded
+        upper_left = mercantile.xy_bounds(x0, y0, zoom)
+        lower_right = mercantile.xy_bounds(max(xs), max(ys), zoom)
+        return image, (upper_left.left, lower_right.right, lower_right.bottom, upper_left.top), missing
+
+
+def interpolate_grid(values: np.ndarray, rows: np.ndarray, columns: np.ndarray, shape) -> np.ndarray:
+    '''Bilinear interpolation of values known on the coarse grid rows x columns to the full shape.'''
+    def weights(known, size):
+        index = np.arange(size)
+        lower = np.clip(np.searchsorted(known, index, side="right") - 1, 0, len(known) - 2)
+        return lower, (index - known[lower]) / (known[lower + 1] - known[lower])
+    row, row_t = weights(rows, shape[0])
+    column, column_t = weights(columns, shape[1])
+    values = values[row] * (1 - row_t)[:, None] + values[row + 1] * row_t[:, None]
+    return values[:, column] * (1 - column_t) + values[:, column + 1] * column_t
+
+
+def warp(image: np.ndarray, extent, crs: str, step: int = 16):
+    '''Reprojects web mercator image to crs by sampling the nearest source pixel of every target pixel.
+
+    Only every step-th pixel is transformed by pyproj, the smooth projection is interpolated in between.'''
+    left, right, bottom, top = extent
+    xmin, ymin, xmax, ymax = Transformer.from_crs(WEB_MERCATOR, crs, always_xy=True).transform_bounds(
+        left, bottom, right, top)
+    height, width = image.shape[:2]
+    xs = xmin + (np.arange(width) + 0.5) * (xmax - xmin) / width
+    ys = ymax - (np.arange(height) + 0.5) * (ymax - ymin) / height
+    coarse_rows = np.unique(np.r_[np.arange(0, height, step), height - 1])
+    coarse_columns = np.unique(np.r_[np.arange(0, width, step), width - 1])
+    mx, my = Transformer.from_crs(crs, WEB_MERCATOR, always_xy=True).transform(
+        *np.meshgrid(xs[coarse_columns], ys[coarse_rows]))
+    mx = interpolate_grid(mx, coarse_rows, coarse_columns, (height, width))
+    my = interpolate_grid(my, coarse_rows, coarse_columns, (height, width))
+    columns = np.floor((mx - left) / (right - left) * width).astype(np.int64)
+    rows = np.floor((top - my) / (top - bottom) * height).astype(np.int64)
+    inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+    warped = np.zeros_like(image)
+    warped[inside] = image[rows[inside], columns[inside]]
+    return warped, (xmin, xmax, ymin, ymax)
+
+
+def clamp_bounds(lonlat_bounds):
+    w, s, e, n = lonlat_bounds
+    return max(w, -180.0), max(s, -MAX_LATITUDE), min(e, 180.0), min(n, MAX_LATITUDE)
+
+
+# mosaics by source, crs, bounds and zoom; subplots sharing axes decode their tiles once
+MOSAICS = OrderedDict()
+MOSAIC_LIMIT = 8
+
+
+def basemap(source: TileSource, crs: str, bounds, zoom="auto"):
+    '''Basemap image reprojected to crs, its extent for the (xmin, ymin, xmax, ymax) bounds in crs
+    and the number of missing tiles.'''
+    lonlat_bounds = Transformer.from_crs(crs, "EPSG:4326", always_xy=True).transform_bounds(*bounds)
+    zoom = source.zoom(lonlat_bounds) if zoom == "auto" else zoom
+    key = (source.key, crs, tuple(bounds), zoom)
+    if key in MOSAICS:
+        MOSAICS.move_to_end(key)
+        return MOSAICS[key]
+    image, extent, missing = source.mosaic(lonlat_bounds, zoom)
+    if CRS.from_user_input(crs) != CRS.from_user_input(WEB_MERCATOR):
+        image, extent = warp(image, extent, crs)
+    MOSAICS[key] = (image, extent, missing)
+    while len(MOSAICS) > MOSAIC_LIMIT:
+        MOSAICS.popitem(last=False)
+    return image, extent, missing
+
+
+def add_basemap(ax, source: TileSource, crs: str, zoom="auto", interpolation: str = "bilinear", **imshow_args):
+    '''Drop-in for contextily.add_basemap drawing tiles of the source under the current extent of ax,
+    missing tiles are drawn transparent with a warning.'''
+    xmin, xmax = ax.get_xlim()
+    ymin, ymax = ax.get_ylim()
+    image, extent, missing = basemap(source, crs, (xmin, ymin, xmax, ymax), zoom)
+    if missing:
+        warnings.warn("%d basemap tiles are missing in %s, seed the store with tiles.py" % (missing, source.store.key))
+    ax.imshow(image, extent=extent, interpolation=interpolation, **imshow_args)
+    ax.axis((xmin, xmax, ymin, ymax))
+
+
+if __name__ == "__main__":
+    from coords import load_coordinates
+
+    main_folder = Path(__file__).parent.parent.resolve()
+    parser = ap.ArgumentParser(description="Prefetch basemap tiles covering accidents of given regions")
+    parser.add_argument("--dataset", default=main_folder / "accidents.pkl.gz")
+    parser.add_argument("--store", default=main_folder / "tiles", help="directory or .mbtiles file")
+    parser.add_argument("--url", required=True, help="tile url template, e.g. https://host/{z}/{x}/{y}.png")
+    parser.add_argument("--regions", nargs="+", default=["PLK"])
+    parser.add_argument("--zooms", nargs="+", type=int, default=[8, 9, 10])
+    arguments = parser.parse_args()
+
+    source = TileSource(open_store(arguments.store, max_bytes=None), arguments.url)
+    # cleaned coordinates, zero and swapped ones would stretch the box across the whole country
+    lon, lat, _ = load_coordinates(arguments.dataset, "EPSG:4326", arguments.regions)
+    if np.isnan(lon).all():
+        raise SystemExit("No valid coordinates in regions %s" % " ".join(arguments.regions))
+    print(source.prefetch((np.nanmin(lon), np.nanmin(lat), np.nanmax(lon), np.nanmax(lat)), arguments.zooms))